@@ -1,7 +1,11 @@
+import asyncio
 from typing import List, Optional
-from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from starlette.concurrency import run_in_threadpool
+from app.core.limiter import limiter
 from app.core.security import get_current_active_user
 from app.services.database_service import db_service
+from config import settings
 from pydantic import BaseModel, Field
 from datetime import datetime
 
@@ -16,6 +20,7 @@ class JobResponse(BaseModel):
     code: Optional[str] = Field(None, alias="generatedCode")
     duration: Optional[float] = None
     errorMessage: Optional[str] = None
+    quality: Optional[str] = None
     createdAt: datetime
     updatedAt: datetime
     
@@ -38,16 +43,18 @@ async def list_public_jobs(
     """
     List public completed jobs (Gallery).
     """
-    jobs = await db_service.list_jobs(
-        limit=limit, 
-        offset=offset, 
-        search=search,
-        status="completed"
-    )
-    
-    total = await db_service.count_jobs(
-        search=search,
-        status="completed"
+    # The page and the total are independent queries; run them concurrently
+    jobs, total = await asyncio.gather(
+        db_service.list_jobs(
+            limit=limit, 
+            offset=offset, 
+            search=search,
+            status="completed"
+        ),
+        db_service.count_jobs(
+            search=search,
+            status="completed"
+        )
     )
     
     return {
@@ -67,16 +74,17 @@ async def list_jobs(
     """
     List user's jobs with filtering.
     """
-    jobs = await db_service.list_jobs(
-        limit=limit, 
-        offset=offset, 
-        user_id=current_user.id,
-        search=search
-    )
-    
-    total = await db_service.count_jobs(
-        user_id=current_user.id,
-        search=search
+    jobs, total = await asyncio.gather(
+        db_service.list_jobs(
+            limit=limit, 
+            offset=offset, 
+            user_id=current_user.id,
+            search=search
+        ),
+        db_service.count_jobs(
+            user_id=current_user.id,
+            search=search
+        )
     )
     
     return {
@@ -104,6 +112,60 @@ async def get_job(
          
     return job
 
+@router.post("/{job_id}/upgrade")
+@limiter.limit("5/minute")
+async def upgrade_job_quality(
+    request: Request,
+    job_id: str,
+    current_user = Depends(get_current_active_user)
+):
+    """
+    Re-render an accepted preview at full quality.
+    
+    Jobs render at PREVIEW_QUALITY first; the video is swapped for the
+    UPGRADE_QUALITY render once it finishes. Upgrades cost no credits, so
+    each job can be upgraded once, and only one upgrade is queued at a time.
+    """
+    job = await db_service.get_job(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    
+    # Ownership check
+    if job.get('userId') != current_user.id:
+         raise HTTPException(status_code=403, detail="Not authorized to upgrade this job")
+    
+    if job['status'] != 'completed' or not job.get('generatedCode'):
+        raise HTTPException(status_code=400, detail="Job not completed")
+    
+    if job.get('quality') == settings.UPGRADE_QUALITY:
+        raise HTTPException(status_code=409, detail="Job is already at full quality")
+    
+    # Import the task here to avoid circular imports
+    from app.tasks import upgrade_animation_quality, claim_upgrade, release_upgrade
+    
+    # Full-quality renders hold a render worker for minutes; don't let
+    # repeated requests queue several of them for the same job
+    if not await run_in_threadpool(claim_upgrade, job_id):
+        raise HTTPException(status_code=409, detail="An upgrade for this job is already in progress")
+    
+    try:
+        task = await run_in_threadpool(
+            upgrade_animation_quality.apply_async,
+            args=[job_id, job['generatedCode'], settings.UPGRADE_QUALITY],
+            time_limit=settings.JOB_TIMEOUT,
+            soft_time_limit=settings.JOB_SOFT_TIMEOUT
+        )
+    except Exception:
+        await run_in_threadpool(release_upgrade, job_id)
+        raise
+    
+    return {
+        "job_id": job_id,
+        "task_id": task.id,
+        "quality": settings.UPGRADE_QUALITY,
+        "message": "Quality upgrade queued"
+    }
+
 @router.delete("/{job_id}")
 async def delete_job(
     job_id: str,
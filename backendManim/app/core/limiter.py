@@ -0,0 +1,7 @@
+from slowapi import Limiter
+from slowapi.util import get_remote_address
+from config import settings
+
+# Shared by the app and its routers; counters live in Redis so the limits
+# hold across gunicorn workers
+limiter = Limiter(key_func=get_remote_address, storage_uri=settings.REDIS_URL)
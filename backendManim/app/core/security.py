@@ -9,6 +9,14 @@ from app.services.database_service import db_service
 
 security = HTTPBearer()
 
+# Shared client so every authenticated request reuses the keep-alive TLS
+# connection to Clerk instead of opening a new one. Connections are opened
+# lazily, so creating it at import is safe under gunicorn --preload.
+http_client = httpx.AsyncClient(
+    timeout=httpx.Timeout(10, connect=3),
+    limits=httpx.Limits(max_connections=20, max_keepalive_connections=10),
+)
+
 async def get_clerk_public_key(kid: str):
     """Fetch Clerk public key from JWKS"""
     if not settings.CLERK_ISSUER:
@@ -16,9 +24,8 @@ async def get_clerk_public_key(kid: str):
         return None
         
     jwks_url = f"{settings.CLERK_ISSUER}/.well-known/jwks.json"
-    async with httpx.AsyncClient() as client:
-        response = await client.get(jwks_url)
-        jwks = response.json()
+    response = await http_client.get(jwks_url)
+    jwks = response.json()
         
     for key in jwks["keys"]:
         if key["kid"] == kid:
@@ -1,9 +1,11 @@
 from fastapi import FastAPI, HTTPException, BackgroundTasks, Depends, Request, Header
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
+from starlette.concurrency import run_in_threadpool
 from pydantic import BaseModel, Field
 import logging
+import uuid
 from pathlib import Path
 from config import settings
 from app.models.job import Job, JobStatus
@@ -17,16 +19,15 @@ from app.services.ai_service import (
     SecurityViolationError
 )
 from app.services.render_service import (
-    execute_manim, 
-    get_video_url, 
+    local_video_path,
     RenderError
 )
 from app.celery_app import celery_app
 from app.api.endpoints import users, jobs, conversations
-from app.core.security import get_current_active_user
+from app.core.security import get_current_active_user, http_client
+from app.core.limiter import limiter
 from typing import Optional
-from slowapi import Limiter, _rate_limit_exceeded_handler
-from slowapi.util import get_remote_address
+from slowapi import _rate_limit_exceeded_handler
 from slowapi.errors import RateLimitExceeded
 from slowapi.middleware import SlowAPIMiddleware
 
@@ -37,13 +38,13 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Rate limiting
-limiter = Limiter(key_func=get_remote_address, storage_uri=settings.REDIS_URL)
-
 app = FastAPI(
     title="Manim Animation Generator", 
     version="3.0.0",
-    description="Generate Manim animations from text prompts using AI with Celery"
+    description="Generate Manim animations from text prompts using AI with Celery",
+    # orjson serialises the job listings and status payloads several times
+    # faster than the stdlib json encoder
+    default_response_class=ORJSONResponse
 )
 app.state.limiter = limiter
 app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
@@ -74,6 +75,7 @@ async def startup_event():
 @app.on_event("shutdown")
 async def shutdown_event():
     await db_service.disconnect()
+    await http_client.aclose()
     logger.info("Application shutdown complete.")
 
 
@@ -145,12 +147,9 @@ async def generate_animation(
 
         # 2. Check Credits & API Key
         user_api_key = None
+        use_credit = current_user.credits > 0
         
-        if current_user.credits > 0:
-            # User has credits
-            await db_service.deduct_credit(current_user.id)
-            logger.info(f"Deducted 1 credit from user {current_user.id}. Remaining: {current_user.credits - 1}")
-        else:
+        if not use_credit:
             # No credits, must use API Key
             if not x_gemini_api_key:
                 raise HTTPException(
@@ -159,28 +158,37 @@ async def generate_animation(
                 )
             user_api_key = x_gemini_api_key
             logger.info(f"User {current_user.id} using custom API Key.")
-            # We still want to track usage count? Yes.
-            await db_service.increment_usage(current_user.id)
-
-        # Import the task here to avoid circular imports
-        from app.tasks import process_animation_job
         
-        # Queue the task with the prompt
-        task = process_animation_job.apply_async(
-            args=[body.prompt, user_api_key],
-            time_limit=settings.JOB_TIMEOUT,
-            soft_time_limit=settings.JOB_SOFT_TIMEOUT
-        )
-
-        await db_service.create_job(
-            job_id=task.id, 
-            prompt=body.prompt, 
+        # 3. Create the job and charge for it in one round trip. The task id
+        # is chosen up front so the job row exists before a worker can
+        # pick the task up.
+        job_id = str(uuid.uuid4())
+        await db_service.create_charged_job(
+            job_id=job_id,
+            prompt=body.prompt,
             user_id=current_user.id,
-            conversation_id=body.conversation_id
+            conversation_id=body.conversation_id,
+            deduct_credit=use_credit
         )
+        if use_credit:
+            logger.info(f"Deducted 1 credit from user {current_user.id}. Remaining: {current_user.credits - 1}")
+
+        # Import the task here to avoid circular imports
+        from app.tasks import process_animation_job
         
-        # We handled credit deduction logic above? No I need to implement it correctly.
-        # Let's replace the whole function body in one go.
+        # Queue the task with the prompt. Publishing is a blocking Redis
+        # round-trip, so keep it off the event loop.
+        try:
+            task = await run_in_threadpool(
+                process_animation_job.apply_async,
+                args=[body.prompt, user_api_key],
+                task_id=job_id,
+                time_limit=settings.JOB_TIMEOUT,
+                soft_time_limit=settings.JOB_SOFT_TIMEOUT
+            )
+        except Exception as e:
+            await db_service.update_job_error(job_id, f"Failed to queue task: {str(e)}")
+            raise
         
         logger.info(f"[Task {task.id}] Created for prompt: {body.prompt[:50]}... User: {current_user.id}")
         
@@ -264,8 +272,25 @@ async def stream_video(job_id: str):
 
     # If it's a local path (starts with /videos/)
     if video_url.startswith('/videos/'):
+         file_path = local_video_path(video_url)
+         if file_path is None:
+             raise HTTPException(status_code=404, detail="Video not accessible")
+         relative_path = file_path.relative_to(settings.VIDEOS_DIR.resolve()).as_posix()
+         
+         # The web server sends the file with sendfile(); no worker streams it
+         if settings.VIDEO_ACCEL_REDIRECT_PREFIX:
+             internal_path = f"{settings.VIDEO_ACCEL_REDIRECT_PREFIX.rstrip('/')}/{relative_path}"
+             return Response(
+                 headers={'X-Accel-Redirect': internal_path},
+                 media_type='video/mp4'
+             )
+         if settings.VIDEO_XSENDFILE:
+             return Response(
+                 headers={'X-Sendfile': str(file_path)},
+                 media_type='video/mp4'
+             )
          from fastapi.responses import RedirectResponse
-         return RedirectResponse(url=video_url)
+         return RedirectResponse(url=f"/videos/{relative_path}")
 
     # If it's already an HTTP URL (legacy S3 or external)
     if video_url.startswith('http'):
@@ -280,10 +305,12 @@ async def stream_video(job_id: str):
 @app.get("/stats")
 async def get_stats():
     """Get system statistics."""
-    total_jobs = await db_service.count_jobs()
-    pending_jobs = await db_service.count_jobs(status='pending')
-    completed_jobs = await db_service.count_jobs(status='completed')
-    failed_jobs = await db_service.count_jobs(status='failed')
+    # One GROUP BY instead of four COUNT round trips
+    counts = await db_service.count_jobs_by_status()
+    total_jobs = sum(counts.values())
+    pending_jobs = counts.get('pending', 0)
+    completed_jobs = counts.get('completed', 0)
+    failed_jobs = counts.get('failed', 0)
     
     return {
         "total_jobs": total_jobs,
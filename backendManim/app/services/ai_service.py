@@ -1,7 +1,29 @@
 """AI service for code generation with error handling and self-correction."""
+import ast
+import contextlib
+import importlib.util
+import io
 import logging
+import os
+import py_compile
+import re
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from functools import lru_cache
 from pathlib import Path
+from typing import NamedTuple
+from typing_extensions import TypedDict
 import google.generativeai as genai
+import numpy as np
+from google.generativeai import caching, protos
+from google.generativeai import client as genai_client
+from google.generativeai.types import GenerateContentResponse, generation_types
+from google.api_core import exceptions as google_exceptions
+import orjson
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential_jitter
+from app.services.cache_service import cache_service
 from config import settings
 
 logger = logging.getLogger(__name__)
@@ -12,6 +34,58 @@ logger = logging.getLogger(__name__)
 # Maximum retry attempts for code generation
 MAX_RETRY_ATTEMPTS = 3
 
+# Attempts per Gemini call on transient API errors (rate limits, overload)
+GEMINI_MAX_ATTEMPTS = 3
+
+_TRANSIENT_GEMINI_ERRORS = (
+    google_exceptions.ResourceExhausted,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.DeadlineExceeded,
+    google_exceptions.InternalServerError,
+)
+
+# Markdown code fence around the generated script. The closing fence has to
+# end the text, so a fence line inside the code (e.g. in a triple-quoted
+# string) does not cut the script short.
+_FENCE_RE = re.compile(r"^```(?:python)?[ \t]*\n(.*)\n```\s*\Z", re.DOTALL | re.MULTILINE)
+# A fenced block that may still be followed by text, while streaming
+_OPEN_FENCE_BLOCK_RE = re.compile(r"^```(?:python)?[ \t]*\n(.*)\n```[ \t]*$", re.DOTALL | re.MULTILINE)
+
+class GeneratedScript(TypedDict):
+    """Response schema for code generation."""
+    code: str
+
+
+# Structured output: the script arrives as a JSON string field instead of
+# markdown, so no fence or prose has to be stripped from it
+_GENERATION_CONFIG = generation_types.to_generation_config_dict(genai.GenerationConfig(
+    response_mime_type="application/json",
+    response_schema=GeneratedScript,
+))
+
+# Smallest system instruction (in tokens) the API accepts as a context
+# cache, by model family; unknown models get the largest known minimum
+_MIN_CACHE_TOKENS = {"gemini-2.5-flash": 1024, "gemini-2.5-pro": 4096}
+_DEFAULT_MIN_CACHE_TOKENS = 4096
+
+
+class _GeminiModel(NamedTuple):
+    """A model bound to one API key's client, with its fixed request prefix."""
+    client: object
+    name: str
+    system_instruction: protos.Content | None = None
+    cached_content: str | None = None
+
+# First line of actual code, after any explanatory text the model added
+_CODE_START_RE = re.compile(r"^(?:from|import|class|def) ", re.MULTILINE)
+
+# The Manim import every generated scene relies on
+_MANIM_IMPORT_RE = re.compile(r"^(?:from manim import|import manim\b)", re.MULTILINE)
+
+# Resolution/frame-rate overrides in generated code would defeat the render
+# quality chosen by the server (e.g. force 1080p on a preview render)
+_OVERRIDDEN_CONFIG_KEYS = frozenset({"pixel_height", "pixel_width", "frame_rate", "quality"})
+
 
 class CodeGenerationError(Exception):
     """Raised when code generation fails."""
@@ -23,66 +97,465 @@ class SecurityViolationError(Exception):
     pass
 
 
-def _get_model(api_key: str = None):
-    """Get configured Gemini model instance."""
+class _IncompleteResponseError(CodeGenerationError):
+    """Raised when a structured response is cut off or has no code field."""
+    pass
+
+
+# Caps in-flight Gemini calls per worker process so concurrent jobs (and
+# parallel fix attempts) stay within the project's RPM/TPM quota
+_gemini_slots = threading.BoundedSemaphore(settings.GEMINI_MAX_CONCURRENT)
+# Slots currently held, for idle_gemini_slots()
+_gemini_slots_in_use = 0
+_gemini_slots_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def _gemini_slot():
+    """Hold one of the GEMINI_MAX_CONCURRENT slots for a Gemini call."""
+    global _gemini_slots_in_use
+    with _gemini_slots:
+        with _gemini_slots_lock:
+            _gemini_slots_in_use += 1
+        try:
+            yield
+        finally:
+            with _gemini_slots_lock:
+                _gemini_slots_in_use -= 1
+
+
+def idle_gemini_slots() -> int:
+    """Number of Gemini calls that could start right now without waiting."""
+    with _gemini_slots_lock:
+        return settings.GEMINI_MAX_CONCURRENT - _gemini_slots_in_use
+
+# One Gemini client (and gRPC channel) per API key, and the models built on
+# it by (key, model name) with the time each should be rebuilt. Models are
+# pinned to their key's client: genai.configure() only swaps the default
+# client, so switching between the server key and user keys neither closes
+# a channel nor lets a call go out under another request's key.
+#
+# _client_lock guards client creation and the SDK's default configuration;
+# _model_lock guards the model table and is never held while a model is
+# built, so a slow context cache upload only holds up callers of that same
+# model (and clients being created for new keys).
+_client_lock = threading.Lock()
+_model_lock = threading.Lock()
+_configured_key: str | None = None
+_clients: dict[str, object] = {}
+_models: dict[tuple[str, str], tuple[_GeminiModel, float]] = {}
+_model_build_locks: dict[tuple[str, str], threading.Lock] = {}
+
+# User keys come and go; keep at most this many of their clients around
+_MAX_USER_CLIENTS = 16
+
+# How long to send the system instruction inline after a context cache
+# upload failed transiently, before trying to create the cache again
+_CACHE_RETRY_SECONDS = 60
+
+
+def _configure(key: str):
+    """Point the SDK's default clients at an API key. Callers must hold _client_lock."""
+    global _configured_key
+    if key != _configured_key:
+        genai.configure(api_key=key)
+        _configured_key = key
+
+
+def _get_client(key: str):
+    """Get the Gemini client for an API key."""
+    client = _clients.get(key)
+    if client is not None:
+        return client
+    
+    with _client_lock:
+        client = _clients.get(key)
+        if client is None:
+            if len(_clients) > _MAX_USER_CLIENTS:
+                for stale_key in [k for k in _clients if k != settings.GEMINI_API_KEY]:
+                    del _clients[stale_key]
+            _configure(key)
+            client = _clients[key] = genai_client.get_default_generative_client()
+    return client
+
+
+def _min_cache_tokens(model_name: str) -> int:
+    """Minimum size of a context cache for a model."""
+    base_name = model_name.removeprefix("models/")
+    for family, min_tokens in _MIN_CACHE_TOKENS.items():
+        if base_name.startswith(family):
+            return min_tokens
+    return _DEFAULT_MIN_CACHE_TOKENS
+
+
+@lru_cache(maxsize=8)
+def _system_instruction_tokens(model_name: str) -> int:
+    """Count the system instruction's tokens once per model."""
+    request = protos.CountTokensRequest(
+        model=model_name,
+        contents=[protos.Content(role="user", parts=[protos.Part(text=settings.system_instruction)])],
+    )
+    return _get_client(settings.GEMINI_API_KEY).count_tokens(request).total_tokens
+
+
+def _create_cached_model(model_name: str) -> str | None:
+    """
+    Upload the system instruction as a Gemini context cache.
+    
+    Returns the cache's name, or None if caching is unavailable. A system
+    instruction below the model's minimum cacheable size is not uploaded
+    at all. Transient errors (rate limits, overload) are raised so the
+    caller can try again soon instead of giving up on caching for a whole TTL.
+    """
+    try:
+        tokens = _system_instruction_tokens(model_name)
+        if tokens < _min_cache_tokens(model_name):
+            logger.info(
+                f"System instruction ({tokens} tokens) is below the context cache minimum "
+                f"for {model_name}, sending it inline"
+            )
+            return None
+        
+        # Cache uploads go through the default client, so the server key
+        # has to stay configured until the request is out
+        with _client_lock:
+            _configure(settings.GEMINI_API_KEY)
+            cache = caching.CachedContent.create(
+                model=model_name,
+                display_name="manim-system-instruction",
+                system_instruction=settings.system_instruction,
+                ttl=timedelta(seconds=settings.GEMINI_CACHE_TTL),
+            )
+        logger.info(f"Created Gemini context cache {cache.name} for {model_name}")
+        return cache.name
+    except _TRANSIENT_GEMINI_ERRORS:
+        raise
+    except google_exceptions.GoogleAPIError as e:
+        logger.info(f"Gemini context caching unavailable, sending system instruction inline: {e}")
+        return None
+
+
+def _build_model(key: str, model_name: str) -> tuple[_GeminiModel, float]:
+    """Build a model for a key and return it with how long it may be used."""
+    if "/" not in model_name:
+        model_name = f"models/{model_name}"
+    # Rebuild a few minutes before the cache TTL runs out
+    lifetime = max(settings.GEMINI_CACHE_TTL - 300, 60)
+    
+    # Only the server key gets a context cache; caches are billed to
+    # the key's project and user keys change from request to request
+    cached_content = None
+    if key == settings.GEMINI_API_KEY and settings.GEMINI_CACHE_TTL > 0:
+        try:
+            cached_content = _create_cached_model(model_name)
+        except _TRANSIENT_GEMINI_ERRORS as e:
+            logger.warning(f"Gemini context cache creation failed, retrying shortly: {e}")
+            lifetime = _CACHE_RETRY_SECONDS
+    
+    # Requests go straight to the key's own client, so a call never goes
+    # out under whichever key the SDK's default client was configured with
+    client = _get_client(key)
+    if cached_content:
+        return _GeminiModel(client, model_name, cached_content=cached_content), lifetime
+    # The system instruction is the same for every call, so send it as the
+    # model's fixed prefix rather than pasting it into each prompt. Gemini
+    # can then reuse its cached prefix across requests.
+    system_instruction = protos.Content(parts=[protos.Part(text=settings.system_instruction)])
+    return _GeminiModel(client, model_name, system_instruction=system_instruction), lifetime
+
+
+def _get_model(api_key: str = None, refresh: bool = False, model_name: str = None):
+    """Get configured Gemini model instance, defaulting to settings.MODEL_NAME."""
     # Use provided key or fallback to settings (if any)
     key = api_key or settings.GEMINI_API_KEY
     if not key:
         raise CodeGenerationError("Gemini API Key is missing. Please provide one.")
+    model_name = model_name or settings.MODEL_NAME
+    entry_key = (key, model_name)
+    
+    with _model_lock:
+        entry = _models.get(entry_key)
+        if entry and not refresh and time.monotonic() < entry[1]:
+            return entry[0]
+        build_lock = _model_build_locks.setdefault(entry_key, threading.Lock())
+    
+    # Single flight: concurrent callers wait for one build instead of each
+    # uploading their own context cache
+    with build_lock:
+        with _model_lock:
+            current = _models.get(entry_key)
+            if current is not entry and current and time.monotonic() < current[1]:
+                # Rebuilt by another caller while this one waited
+                return current[0]
+        
+        model, lifetime = _build_model(key, model_name)
+        
+        with _model_lock:
+            _models[entry_key] = (model, time.monotonic() + lifetime)
+            # Drop models of user keys whose clients were evicted
+            for stale in [m for m in _models if m[0] not in _clients]:
+                del _models[stale]
+                _model_build_locks.pop(stale, None)
+        return model
+
+
+def _generate_text(prompt: str, api_key: str = None, model_name: str = None, temperature: float = None) -> str:
+    """Send a prompt to Gemini and return the response text."""
+    model = _get_model(api_key, model_name=model_name)
+    with _gemini_slot():
+        try:
+            return _stream_text(model, prompt, temperature)
+        except google_exceptions.NotFound:
+            # The context cache expired or was evicted server-side
+            model = _get_model(api_key, refresh=True, model_name=model_name)
+            return _stream_text(model, prompt, temperature)
+
+
+def _stream_text(model: _GeminiModel, prompt: str, temperature: float = None) -> str:
+    """
+    Stream a response and stop reading once a fenced code block is closed.
+    
+    Structured JSON responses are read to the end. When the model falls back
+    to markdown, anything it writes after the code (explanations, notes) is
+    not needed, so the response is cut at the closing fence. A fence line is
+    only taken as the closing one if the code before it parses; one inside a
+    triple-quoted string leaves the string unterminated.
+    """
+    buffer = io.StringIO()
+    structured = None
+    generation_config = dict(_GENERATION_CONFIG)
+    if temperature is not None:
+        generation_config["temperature"] = temperature
+    request = protos.GenerateContentRequest(
+        model=model.name,
+        contents=[protos.Content(role="user", parts=[protos.Part(text=prompt)])],
+        generation_config=generation_config,
+        system_instruction=model.system_instruction,
+        cached_content=model.cached_content,
+    )
+    for response in model.client.stream_generate_content(request):
+        chunk = GenerateContentResponse.from_response(response)
+        # Safety and finish-reason chunks carry no text parts
+        if not chunk.parts:
+            continue
+        text = chunk.text
+        buffer.write(text)
+        if structured is None and text.strip():
+            structured = text.lstrip().startswith("{")
+        # A fence can be split across chunks, so test for any backtick. JSON
+        # responses are never cut short, and backticks inside the code must
+        # not trigger a rescan of the whole buffer.
+        if not structured and "`" in text:
+            fence_match = _OPEN_FENCE_BLOCK_RE.search(buffer.getvalue())
+            if fence_match:
+                try:
+                    ast.parse(fence_match.group(1))
+                    return buffer.getvalue()[:fence_match.end()]
+                except SyntaxError:
+                    pass
+    return buffer.getvalue()
+
+
+@lru_cache(maxsize=256)
+def _embed_prompt(prompt: str, api_key: str = None) -> np.ndarray:
+    """
+    Embed a prompt for semantic cache lookups.
+    
+    Cached because the same prompt is embedded for the lookup and again when
+    its rendered code is stored.
+    """
+    key = api_key or settings.GEMINI_API_KEY
+    if not key:
+        raise CodeGenerationError("Gemini API Key is missing. Please provide one.")
+    client = _get_client(key)
+    
+    result = genai.embed_content(
+        model=settings.EMBEDDING_MODEL,
+        content=prompt,
+        task_type="SEMANTIC_SIMILARITY",
+        client=client,
+    )
+    embedding = np.asarray(result["embedding"], dtype=np.float32)
+    return embedding / np.linalg.norm(embedding)
+
+
+def _find_security_violation(tree: ast.AST) -> str | None:
+    """Return a description of the first blocked construct in the tree, if any."""
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            modules = [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom):
+            # Relative imports have no module of ours to come from
+            modules = [node.module or ""] if node.level == 0 else ["." * node.level]
+        else:
+            modules = []
         
-    genai.configure(api_key=key)
-    return genai.GenerativeModel(settings.MODEL_NAME)
+        for module in modules:
+            if module.split(".")[0] not in settings.allowed_modules:
+                return f"import {module}"
+        
+        if isinstance(node, ast.Name) and (
+            node.id in settings.blocked_names or node.id in settings.blocked_modules
+        ):
+            return node.id
+        if isinstance(node, ast.Attribute) and (
+            node.attr in settings.blocked_attributes or node.attr in settings.blocked_names
+        ):
+            return f".{node.attr}"
+        # Names looked up by string, e.g. through attrgetter or a dict
+        if isinstance(node, ast.Constant) and node.value in settings.blocked_attributes:
+            return repr(node.value)
+    
+    return None
 
 
 def sanitize_code(code: str) -> str:
     """
-    Check generated code for dangerous patterns.
+    Check generated code for dangerous imports, builtins and attributes.
+    
+    The code is parsed once and checked structurally, which also catches
+    aliased imports (`import os as o`) and builtins passed around by name.
     
     Raises:
         SecurityViolationError: If dangerous patterns are found.
     """
-    code_lower = code.lower()
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        # Code that does not parse cannot run either; the render reports
+        # the syntax error and the fix loop takes it from there
+        return code
     
-    for pattern in settings.dangerous_patterns:
-        if pattern.lower() in code_lower:
-            logger.warning(f"Security violation detected: {pattern}")
-            raise SecurityViolationError(
-                f"Generated code contains dangerous pattern: {pattern}. "
-                "Code generation rejected for security reasons."
-            )
+    violation = _find_security_violation(tree)
+    if violation:
+        logger.warning(f"Security violation detected: {violation}")
+        raise SecurityViolationError(
+            f"Generated code contains dangerous pattern: {violation}. "
+            "Code generation rejected for security reasons."
+        )
     
     return code
 
 
+def _is_config_override(target: ast.expr) -> bool:
+    """Whether an assignment target is `config.<key>` or `config["<key>"]`."""
+    if isinstance(target, ast.Attribute):
+        key = target.attr
+    elif isinstance(target, ast.Subscript) and isinstance(target.slice, ast.Constant):
+        key = target.slice.value
+    else:
+        return False
+    return (
+        isinstance(target.value, ast.Name)
+        and target.value.id == "config"
+        and key in _OVERRIDDEN_CONFIG_KEYS
+    )
+
+
+def _strip_config_overrides(code: str) -> str:
+    """
+    Replace assignments to render-quality config keys with `pass`.
+    
+    The statement is replaced rather than deleted so a block whose only
+    statement was the override (`if ...: config.pixel_height = 1080`) still
+    parses. Code that does not parse is returned unchanged.
+    """
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return code
+    
+    overrides = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Assign):
+            targets = node.targets
+        elif isinstance(node, (ast.AugAssign, ast.AnnAssign)):
+            targets = [node.target]
+        else:
+            continue
+        if any(_is_config_override(target) for target in targets):
+            overrides.append(node)
+    if not overrides:
+        return code
+    
+    # AST column offsets count UTF-8 bytes
+    lines = code.encode("utf-8").splitlines(keepends=True)
+    for node in sorted(overrides, key=lambda n: (n.lineno, n.col_offset), reverse=True):
+        first, last = node.lineno - 1, node.end_lineno - 1
+        lines[first:last + 1] = [
+            lines[first][:node.col_offset] + b"pass" + lines[last][node.end_col_offset:]
+        ]
+    return b"".join(lines).decode("utf-8")
+
+
 def _clean_code_response(response_text: str) -> str:
     """Clean up AI response to extract pure Python code."""
     if not response_text:
         return ""
     
-    # Remove markdown code blocks
-    clean_code = response_text.replace("```python", "").replace("```", "").strip()
+    # Extract the body of the markdown code block, if any
+    fence_match = _FENCE_RE.search(response_text)
+    clean_code = fence_match.group(1).strip() if fence_match else response_text.strip()
     
-    # Remove any leading/trailing explanatory text
-    lines = clean_code.split('\n')
-    code_lines = []
-    in_code = False
+    # Remove any leading explanatory text: start at the first import or class/def
+    code_start = _CODE_START_RE.search(clean_code)
+    if code_start:
+        clean_code = clean_code[code_start.start():]
     
-    for line in lines:
-        # Start capturing at import or class/def
-        if not in_code and (line.startswith('from ') or line.startswith('import ') or 
-                           line.startswith('class ') or line.startswith('def ')):
-            in_code = True
-        
-        if in_code:
-            code_lines.append(line)
+    return _strip_config_overrides(clean_code)
+
+
+def _parse_code_response(response_text: str) -> str:
+    """
+    Extract the script from a structured response, falling back to text cleanup.
+    
+    Raises:
+        _IncompleteResponseError: If the response is JSON without a usable
+            code field, e.g. truncated at the output token limit. Cleaning up
+            the JSON text as if it were code could only produce a syntax error.
+    """
+    try:
+        code = _strip_config_overrides(orjson.loads(response_text)["code"].strip())
+    except (ValueError, KeyError, TypeError, AttributeError):
+        if response_text.lstrip().startswith("{"):
+            raise _IncompleteResponseError("AI returned an incomplete JSON response")
+        # A markdown response that ignored the schema
+        code = _clean_code_response(response_text)
+    
+    # A dropped star import fails every name in the scene at render time
+    if code and not _MANIM_IMPORT_RE.search(code):
+        code = "from manim import *\n\n" + code
+    return code
+
+
+@retry(
+    retry=retry_if_exception_type((*_TRANSIENT_GEMINI_ERRORS, _IncompleteResponseError)),
+    stop=stop_after_attempt(GEMINI_MAX_ATTEMPTS),
+    wait=wait_exponential_jitter(initial=1, max=10),
+    reraise=True,
+)
+def _request_code(prompt: str, api_key: str = None, model_name: str = None, temperature: float = None) -> str:
+    """
+    Ask Gemini for a script.
     
-    return '\n'.join(code_lines) if code_lines else clean_code
+    Transient API errors and incomplete responses share one budget of
+    GEMINI_MAX_ATTEMPTS calls. Retries back off with jitter so concurrent
+    workers do not hammer a throttled endpoint in lockstep, and the wait
+    happens outside the concurrency slot.
+    """
+    response_text = _generate_text(prompt, api_key, model_name, temperature)
+    if not response_text:
+        raise CodeGenerationError("AI returned empty response")
+    return _parse_code_response(response_text)
 
 
 def generate_code(prompt: str, api_key: str = None) -> str:
     """
     Generate Manim animation code using Gemini AI.
     
+    Prompts that were already rendered successfully are served from the
+    code cache without calling Gemini.
+    
     Args:
         prompt: User's animation description
         api_key: Optional API key override
@@ -94,18 +567,29 @@ def generate_code(prompt: str, api_key: str = None) -> str:
         CodeGenerationError: If generation fails
         SecurityViolationError: If code contains dangerous patterns
     """
-    full_prompt = f"{settings.system_instruction}\n\nRequest: {prompt}"
+    full_prompt = f"Request: {prompt}"
+    
+    cached_code = cache_service.get_code(prompt)
+    if cached_code:
+        logger.info(f"Code cache hit for prompt: {prompt[:100]}...")
+        # Re-check in case the blocked lists changed since it was cached
+        return sanitize_code(cached_code)
+    
+    if cache_service.semantic_enabled:
+        try:
+            cached_code = cache_service.find_similar_code(_embed_prompt(prompt, api_key))
+        except google_exceptions.GoogleAPIError as e:
+            # An embedding failure only costs us the cache lookup
+            logger.warning(f"Prompt embedding failed: {str(e)}")
+            cached_code = None
+        if cached_code:
+            logger.info(f"Semantic cache hit for prompt: {prompt[:100]}...")
+            return sanitize_code(cached_code)
     
     try:
         logger.info(f"Generating code for prompt: {prompt[:100]}...")
         
-        model = _get_model(api_key)
-        response = model.generate_content(full_prompt)
-        
-        if not response.text:
-            raise CodeGenerationError("AI returned empty response")
-        
-        clean_code = _clean_code_response(response.text)
+        clean_code = _request_code(full_prompt, api_key)
         
         # Security check
         sanitize_code(clean_code)
@@ -120,7 +604,14 @@ def generate_code(prompt: str, api_key: str = None) -> str:
         raise CodeGenerationError(f"Failed to generate code: {str(e)}")
 
 
-def fix_code(original_prompt: str, failed_code: str, error_message: str, attempt: int, api_key: str = None) -> str:
+def fix_code(
+    original_prompt: str,
+    failed_code: str,
+    error_message: str,
+    attempt: int,
+    api_key: str = None,
+    temperature: float = None
+) -> str:
     """
     Ask AI to fix code that failed to render.
     
@@ -130,6 +621,7 @@ def fix_code(original_prompt: str, failed_code: str, error_message: str, attempt
         error_message: The error message from Manim
         attempt: Current attempt number (1-indexed)
         api_key: Optional API key override
+        temperature: Sampling temperature override, for diverse fix candidates
         
     Returns:
         Fixed Python code
@@ -139,9 +631,7 @@ def fix_code(original_prompt: str, failed_code: str, error_message: str, attempt
         SecurityViolationError: If fixed code contains dangerous patterns
     """
     
-    fix_prompt = f"""{settings.system_instruction}
-
-IMPORTANT: The previous code you generated failed with an error. You must fix it.
+    fix_prompt = f"""IMPORTANT: The previous code you generated failed with an error. You must fix it.
 
 Original Request: {original_prompt}
 
@@ -155,44 +645,12 @@ Error Message:
 
 Fix Attempt: {attempt}/{MAX_RETRY_ATTEMPTS}
 
-COMMON MANIM ERRORS AND FIXES:
-
-1. TypeError: unsupported operand type(s) for -: 'method' and 'float'
-   - CAUSE: Using .center instead of .get_center()
-   - FIX: Replace obj.center with obj.get_center()
-   - Also applies to: .top -> .get_top(), .bottom -> .get_bottom(), etc.
-
-2. NameError: name 'PINK_D' is not defined
-   - CAUSE: Invalid color name (PINK_D, ORANGE_D, etc. do not exist)
-   - FIX: Use valid colors: PINK, ORANGE, RED, BLUE. Use hex codes for custom colors.
-
-3. NameError: name 'ORANGE_D' is not defined
-   - CAUSE: Invalid color name
-   - FIX: Use ORANGE or hex code "#FFA500"
-
-4. TypeError: shift() got unexpected keyword argument
-   - CAUSE: Wrong method signature
-   - FIX: Use .shift(direction * amount) not .shift(x=1, y=2)
-
-5. ValueError: numpy array shape issues
-   - CAUSE: 2D coordinates instead of 3D
-   - FIX: Use np.array([x, y, 0]) for all positions
-
-6. AttributeError: 'ManimConfig' object has no attribute 'frame_x_range'
-   - CAUSE: Using non-existent config attributes like frame_x_range, frame_y_range, x_min, x_max
-   - FIX: Do NOT use config properties. Use hardcoded values or config.frame_width.
-   - Default frame width is approx 14.2, height is 8.0.
-
-7. AttributeError: Axes object has no attribute 'add_labels'
-   - CAUSE: .add_labels() does not exist in Manim Community.
-   - FIX: Remove .add_labels(). Use .add_coordinates() to show numbers. To label axes names, use axes.get_axis_labels().
-
 Instructions:
 1. Analyze the error message carefully - the error type and line number are crucial
-2. Find the EXACT line causing the error and fix it
+2. Find the EXACT line causing the error and fix it, using the SELF-CORRECTION CHEATSHEET for known errors
 3. Generate COMPLETE corrected code (not just the fix)
 4. Double-check all .center, .top, .bottom, .left, .right - they should be .get_center(), .get_top(), etc.
-5. Return ONLY the complete corrected Python code, no explanations
+5. Return the complete corrected Python code in the `code` field, no explanations
 
 Generate the fixed code now:"""
 
@@ -200,13 +658,9 @@ Generate the fixed code now:"""
         logger.info(f"Attempting to fix code (attempt {attempt}/{MAX_RETRY_ATTEMPTS})...")
         logger.info(f"Error being fixed: {error_message[:200]}...")
         
-        model = _get_model(api_key)
-        response = model.generate_content(fix_prompt)
-        
-        if not response.text:
-            raise CodeGenerationError("AI returned empty response when fixing code")
-        
-        clean_code = _clean_code_response(response.text)
+        # First drafts come from the fast model; code that already failed
+        # once is escalated to the stronger one
+        clean_code = _request_code(fix_prompt, api_key, settings.FIX_MODEL_NAME, temperature)
         
         # Security check
         sanitize_code(clean_code)
@@ -221,6 +675,17 @@ Generate the fixed code now:"""
         raise CodeGenerationError(f"Failed to fix code: {str(e)}")
 
 
+def remember_code(prompt: str, code: str, api_key: str = None) -> None:
+    """Cache code that rendered successfully, for this prompt and similar ones."""
+    cache_service.set_code(prompt, code)
+    
+    if cache_service.semantic_enabled:
+        try:
+            cache_service.add_embedding(prompt, _embed_prompt(prompt, api_key))
+        except google_exceptions.GoogleAPIError as e:
+            logger.warning(f"Prompt embedding failed: {str(e)}")
+
+
 def save_code(code: str, filename: Path = None) -> str:
     """
     Save generated code to file.
@@ -235,10 +700,39 @@ def save_code(code: str, filename: Path = None) -> str:
         # Ensure parent directory exists
         Path(filename).parent.mkdir(parents=True, exist_ok=True)
         
-        with open(filename, "w") as f:
-            f.write(code)
+        # Write to a temp file next to the target and swap it in atomically,
+        # so a render never picks up a half-written script
+        fd, tmp_path = tempfile.mkstemp(dir=Path(filename).parent, suffix=".tmp")
+        try:
+            data = memoryview(code.encode("utf-8"))
+            while data:
+                data = data[os.write(fd, data):]
+            os.fsync(fd)
+        except BaseException:
+            os.close(fd)
+            os.unlink(tmp_path)
+            raise
+        os.close(fd)
+        os.replace(tmp_path, filename)
+        
+        # Prime __pycache__ so the render worker loads bytecode directly
+        try:
+            py_compile.compile(str(filename), doraise=True)
+        except py_compile.PyCompileError as e:
+            # Syntax errors are reported by the render and fed to fix_code
+            logger.debug(f"Could not precompile {filename}: {e.msg}")
+        
         logger.info(f"Code saved to {filename}")
         return str(filename)
-    except IOError as e:
+    except OSError as e:
         logger.error(f"Failed to save code: {str(e)}")
         raise CodeGenerationError(f"Failed to save code: {str(e)}")
+
+
+def discard_code(filename: Path) -> None:
+    """Remove a per-job script and the bytecode save_code compiled for it."""
+    for path in (Path(filename), Path(importlib.util.cache_from_source(str(filename)))):
+        try:
+            path.unlink(missing_ok=True)
+        except OSError as e:
+            logger.warning(f"Failed to remove {path}: {str(e)}")
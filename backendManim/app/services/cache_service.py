@@ -0,0 +1,286 @@
+"""Redis-backed cache of generated Manim code."""
+import hashlib
+import logging
+import threading
+import time
+from typing import Optional
+import numpy as np
+import redis
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+# Index changes kept for workers to catch up on; one that falls further
+# behind reloads the whole index
+_INDEX_LOG_MAXLEN = 10000
+
+
+class CodeCacheService:
+    """Maps prompts to code that has already rendered successfully."""
+
+    def __init__(self):
+        self.enabled = settings.CODE_CACHE_TTL > 0
+        # Vectors from different embedding models have different sizes and
+        # are not comparable, so each model gets its own index
+        self._embeddings_key = f"manim:code:embeddings:{settings.EMBEDDING_MODEL}"
+        # When each indexed entry was last stored, for expiry and the size cap
+        self._embeddings_lru_key = f"{self._embeddings_key}:lru"
+        # Stream of index changes ("+" or "-" and the entry's code key), so
+        # workers apply what changed instead of downloading the whole index
+        self._embeddings_log_key = f"{self._embeddings_key}:log"
+
+        if self.enabled:
+            # Connections are opened lazily and redis-py resets its pool after
+            # a fork, so a module-level client is safe for Celery and gunicorn
+            self.client = redis.Redis.from_url(settings.REDIS_URL, decode_responses=True)
+            # Embeddings are stored as raw float32 bytes
+            self.binary_client = redis.Redis.from_url(settings.REDIS_URL)
+
+        self.semantic_enabled = self.enabled and settings.SEMANTIC_CACHE_THRESHOLD > 0
+
+        # Local copy of the embedding index, kept up to date from the change
+        # log; the matrix is rebuilt from the vectors when they change
+        self._index_lock = threading.Lock()
+        self._index_last_id: bytes | None = None
+        self._index_vectors: dict[str, np.ndarray] = {}
+        self._index_keys: list[str] = []
+        self._index_matrix = np.empty((0, 0), dtype=np.float32)
+        self._index_stale = False
+
+    @staticmethod
+    def _normalize_prompt(prompt: str) -> str:
+        """
+        Reduce a prompt to what matters for the generated code.
+
+        Prompts filled in from the same template often differ only in spacing;
+        collapsing it lets them share one exact cache entry. Case is kept, as
+        it can change the meaning (LaTeX symbols, formulas, quoted text).
+        """
+        return " ".join(prompt.split())
+
+    def _code_key(self, prompt: str) -> str:
+        """Cache key covering everything that shapes the generated code."""
+        digest = hashlib.sha256(
+            "\0".join([
+                settings.MODEL_NAME, settings.system_instruction, self._normalize_prompt(prompt)
+            ]).encode("utf-8")
+        ).hexdigest()
+        return f"manim:code:{digest}"
+
+    def _owner_key(self, code: str) -> str:
+        """Reverse-lookup key from a piece of cached code to the entries holding it."""
+        # Own prefix so the sets never hit the string keys older entries
+        # used for a single owner (those simply expire)
+        return f"manim:code:owners:{hashlib.sha256(code.encode('utf-8')).hexdigest()}"
+
+    def get_code(self, prompt: str) -> Optional[str]:
+        """
+        Look up cached code for a prompt.
+
+        Returns:
+            The cached code, or None on a miss or if Redis is unavailable
+        """
+        if not self.enabled:
+            return None
+
+        try:
+            return self.client.get(self._code_key(prompt))
+        except redis.RedisError as e:
+            logger.warning(f"Code cache lookup failed: {str(e)}")
+            return None
+
+    def set_code(self, prompt: str, code: str) -> None:
+        """Store code that rendered successfully for a prompt."""
+        if not self.enabled:
+            return
+
+        code_key = self._code_key(prompt)
+        try:
+            pipe = self.client.pipeline()
+            pipe.set(code_key, code, ex=settings.CODE_CACHE_TTL)
+            # The same code is stored again under every prompt it is served
+            # for from a similar one, so it can have several owners
+            owner_key = self._owner_key(code)
+            pipe.sadd(owner_key, code_key)
+            pipe.expire(owner_key, settings.CODE_CACHE_TTL)
+            pipe.execute()
+        except redis.RedisError as e:
+            logger.warning(f"Code cache store failed: {str(e)}")
+
+    def invalidate_code(self, code: str) -> None:
+        """
+        Drop cached code that failed to render.
+
+        Entries are only stored once they have rendered, but a Manim upgrade or
+        a changed render setting can break them later. Whichever prompt the code
+        was served for (exact or similar), its entry and embedding are removed.
+        """
+        if not self.enabled:
+            return
+
+        try:
+            owner_key = self._owner_key(code)
+            owners = list(self.client.smembers(owner_key))
+            if not owners:
+                return
+            # A prompt's entry may have been replaced with other code since
+            stale_keys = [
+                code_key for code_key, cached in zip(owners, self.client.mget(owners))
+                if cached == code
+            ]
+            self.client.delete(owner_key, *stale_keys)
+            if self.semantic_enabled:
+                self._remove_embeddings(stale_keys)
+            logger.info(f"Invalidated cached code {', '.join(stale_keys)}")
+        except redis.RedisError as e:
+            logger.warning(f"Code cache invalidation failed: {str(e)}")
+
+    def _remove_embeddings(self, code_keys: list[str]) -> None:
+        """Drop cache entries from the embedding index."""
+        if not code_keys:
+            return
+        pipe = self.binary_client.pipeline()
+        pipe.hdel(self._embeddings_key, *code_keys)
+        pipe.zrem(self._embeddings_lru_key, *code_keys)
+        for code_key in code_keys:
+            pipe.xadd(
+                self._embeddings_log_key, {"op": "-", "key": code_key},
+                maxlen=_INDEX_LOG_MAXLEN, approximate=True,
+            )
+        pipe.execute()
+
+    @staticmethod
+    def _stream_id(entry_id: bytes) -> tuple[int, int]:
+        """Order of a stream entry id ("<ms>-<seq>")."""
+        ms, seq = entry_id.split(b"-")
+        return int(ms), int(seq)
+
+    def _reload_index(self) -> None:
+        """Download the whole embedding index and the change log position it matches."""
+        pipe = self.binary_client.pipeline()
+        pipe.xrevrange(self._embeddings_log_key, count=1)
+        pipe.hgetall(self._embeddings_key)
+        latest, entries = pipe.execute()
+        self._index_last_id = latest[0][0] if latest else b"0-0"
+        self._index_vectors = {
+            key.decode("utf-8"): np.frombuffer(vector, dtype=np.float32)
+            for key, vector in entries.items()
+        }
+        self._index_stale = True
+        if self._index_vectors:
+            # Entries indexed before the LRU set existed expire at the next store
+            self.binary_client.zadd(
+                self._embeddings_lru_key, dict.fromkeys(self._index_vectors, 0), nx=True
+            )
+
+    def _load_index(self) -> None:
+        """Apply index changes made since the last lookup to the local matrix."""
+        if self._index_last_id is None:
+            self._reload_index()
+        else:
+            pipe = self.binary_client.pipeline()
+            pipe.xrange(self._embeddings_log_key, count=1)
+            pipe.xrange(self._embeddings_log_key, min=b"(" + self._index_last_id)
+            first, changes = pipe.execute()
+            if first and self._stream_id(first[0][0]) > self._stream_id(self._index_last_id):
+                # The log was trimmed past this worker's position
+                self._reload_index()
+            elif changes:
+                self._index_last_id = changes[-1][0]
+                added = {}
+                for _, fields in changes:
+                    code_key = fields[b"key"].decode("utf-8")
+                    if fields[b"op"] == b"+":
+                        added[code_key] = True
+                    else:
+                        added.pop(code_key, None)
+                        self._index_vectors.pop(code_key, None)
+                if added:
+                    keys = list(added)
+                    vectors = self.binary_client.hmget(self._embeddings_key, keys)
+                    for code_key, vector in zip(keys, vectors):
+                        if vector is not None:
+                            self._index_vectors[code_key] = np.frombuffer(vector, dtype=np.float32)
+                self._index_stale = True
+
+        if self._index_stale:
+            self._index_keys = list(self._index_vectors)
+            self._index_matrix = (
+                np.vstack(list(self._index_vectors.values()))
+                if self._index_vectors else np.empty((0, 0), dtype=np.float32)
+            )
+            self._index_stale = False
+
+    def find_similar_code(self, embedding: np.ndarray) -> Optional[str]:
+        """
+        Look up code generated for a prompt similar to the given one.
+
+        Args:
+            embedding: L2-normalised embedding of the new prompt
+
+        Returns:
+            Code of the most similar cached prompt above
+            SEMANTIC_CACHE_THRESHOLD, or None
+        """
+        if not self.semantic_enabled:
+            return None
+
+        try:
+            with self._index_lock:
+                self._load_index()
+                if not self._index_keys:
+                    return None
+                # Rows are normalised, so the dot product is the cosine similarity
+                similarities = self._index_matrix @ embedding
+                best = int(np.argmax(similarities))
+                if similarities[best] < settings.SEMANTIC_CACHE_THRESHOLD:
+                    return None
+                code_key = self._index_keys[best]
+
+            code = self.client.get(code_key)
+            if code is None:
+                # The code expired; drop its embedding too
+                self._remove_embeddings([code_key])
+            return code
+        except redis.RedisError as e:
+            logger.warning(f"Semantic cache lookup failed: {str(e)}")
+            return None
+
+    def add_embedding(self, prompt: str, embedding: np.ndarray) -> None:
+        """
+        Index a prompt whose code is in the cache for similarity lookups.
+
+        Entries whose code has expired, and the least recently stored ones
+        beyond SEMANTIC_CACHE_MAX_ENTRIES, are dropped from the index.
+        """
+        if not self.semantic_enabled:
+            return
+
+        code_key = self._code_key(prompt)
+        now = time.time()
+        try:
+            pipe = self.binary_client.pipeline()
+            pipe.hset(self._embeddings_key, code_key, embedding.astype(np.float32).tobytes())
+            pipe.zadd(self._embeddings_lru_key, {code_key: now})
+            pipe.xadd(
+                self._embeddings_log_key, {"op": "+", "key": code_key},
+                maxlen=_INDEX_LOG_MAXLEN, approximate=True,
+            )
+            # set_code refreshes the code's TTL whenever it is stored, so an
+            # entry not stored again within one TTL has expired
+            pipe.zrangebyscore(self._embeddings_lru_key, "-inf", now - settings.CODE_CACHE_TTL)
+            pipe.zcard(self._embeddings_lru_key)
+            *_, expired, size = pipe.execute()
+
+            stale = {key.decode("utf-8") for key in expired}
+            overflow = size - len(stale) - settings.SEMANTIC_CACHE_MAX_ENTRIES
+            if overflow > 0:
+                oldest = self.binary_client.zrange(self._embeddings_lru_key, 0, len(stale) + overflow - 1)
+                stale.update(key.decode("utf-8") for key in oldest)
+            self._remove_embeddings(list(stale))
+        except redis.RedisError as e:
+            logger.warning(f"Semantic cache store failed: {str(e)}")
+
+
+# Global instance
+cache_service = CodeCacheService()
@@ -1,4 +1,5 @@
-from prisma import Prisma
+from prisma import Prisma, errors
+import asyncio
 from typing import Optional, List
 from datetime import datetime, timedelta
 import logging
@@ -11,12 +12,15 @@ class DatabaseService:
         self.db = Prisma()
         self.prisma = self.db
         self._connected = False
+        self._connect_lock = asyncio.Lock()
 
     async def connect(self):
-        if not self._connected:
-            await self.db.connect()
-            self._connected = True
-            logger.info("Connected to the database.")
+        # Concurrent tasks on the same loop may race to open the connection
+        async with self._connect_lock:
+            if not self._connected:
+                await self.db.connect()
+                self._connected = True
+                logger.info("Connected to the database.")
 
     async def disconnect(self):
         if self._connected:
@@ -39,6 +43,37 @@ class DatabaseService:
         job = await self.db.job.create(data=data)
         return job.dict()
     
+    async def create_charged_job(
+        self,
+        job_id: str,
+        prompt: str,
+        user_id: str,
+        conversation_id: Optional[str] = None,
+        deduct_credit: bool = True
+    ) -> None:
+        """
+        Create a job and record the generation against the user.
+        
+        Both writes go out as one batched transaction, so the request pays a
+        single round trip and a job never exists without its charge.
+        """
+        data = {
+            'id': job_id,
+            'prompt': prompt,
+            'status': 'PENDING',
+            'userId': user_id,
+        }
+        if conversation_id:
+            data['conversationId'] = conversation_id
+        
+        usage = {'generationCount': {'increment': 1}}
+        if deduct_credit:
+            usage['credits'] = {'decrement': 1}
+        
+        async with self.db.batch_() as batch:
+            batch.job.create(data=data)
+            batch.user.update(where={'id': user_id}, data=usage)
+    
     async def create_conversation(self, user_id: str, title: str) -> dict:
         """Create a new conversation."""
         conversation = await self.db.conversation.create(
@@ -90,14 +125,14 @@ class DatabaseService:
         if not conv:
             return None
         
-        # Cleanup S3 files for all jobs in this conversation
-        if conv.jobs:
-            for job in conv.jobs:
-                if job.s3Key:
-                    try:
-                        s3_service.delete_video(job.s3Key)
-                    except Exception as e:
-                        logger.error(f"Failed to delete S3 file for job {job.id}: {e}")
+        # Cleanup S3 files for all jobs in this conversation. boto3 is
+        # blocking, so keep it off the event loop.
+        s3_keys = [job.s3Key for job in conv.jobs or [] if job.s3Key]
+        if s3_keys:
+            try:
+                await asyncio.to_thread(s3_service.delete_videos, s3_keys)
+            except Exception as e:
+                logger.error(f"Failed to delete S3 files for conversation {conversation_id}: {e}")
             
         await self.db.conversation.delete(where={'id': conversation_id})
         return conv.dict()
@@ -146,7 +181,8 @@ class DatabaseService:
         video_url: str, 
         execution_log: str,
         generated_code: Optional[str] = None,
-        s3_key: Optional[str] = None
+        s3_key: Optional[str] = None,
+        quality: Optional[str] = None
     ) -> dict:
         """Update job with results."""
         job = await self.db.job.update(
@@ -157,11 +193,34 @@ class DatabaseService:
                 's3Key': s3_key,
                 'executionLog': execution_log,
                 'generatedCode': generated_code,
+                'quality': quality,
                 'updatedAt': datetime.utcnow()
             }
         )
         return job.dict()
     
+    async def update_job_video(
+        self,
+        job_id: str,
+        video_url: str,
+        s3_key: Optional[str] = None,
+        quality: Optional[str] = None
+    ) -> Optional[dict]:
+        """Point a completed job at a new rendering of its video; None if the job is gone."""
+        try:
+            job = await self.db.job.update(
+                where={'id': job_id},
+                data={
+                    'videoUrl': video_url,
+                    's3Key': s3_key,
+                    'quality': quality,
+                    'updatedAt': datetime.utcnow()
+                }
+            )
+        except errors.RecordNotFoundError:
+            return None
+        return job.dict() if job else None
+    
     async def update_job_error(self, job_id: str, error_message: str) -> dict:
         """Update job with error."""
         job = await self.db.job.update(
@@ -223,7 +282,7 @@ class DatabaseService:
         # Delete from S3 if key exists
         if job.s3Key:
             try:
-                s3_service.delete_video(job.s3Key)
+                await asyncio.to_thread(s3_service.delete_video, job.s3Key)
             except Exception as e:
                 logger.error(f"Failed to delete S3 file for job {job_id}: {e}")
 
@@ -247,6 +306,11 @@ class DatabaseService:
             
         return await self.db.job.count(where=where)
     
+    async def count_jobs_by_status(self) -> dict:
+        """Count all jobs per status in a single grouped query."""
+        groups = await self.db.job.group_by(by=['status'], count=True)
+        return {group['status']: group['_count']['_all'] for group in groups}
+    
     async def delete_old_jobs(self, days: int = 30) -> int:
         """Delete jobs older than specified days."""
         cutoff_date = datetime.utcnow() - timedelta(days=days)
@@ -1,15 +1,67 @@
-import subprocess
+import ast
+import contextlib
+import hashlib
 import logging
-import sys
+import multiprocessing
+import os
+import shutil
+import threading
+import time
+import traceback
 import uuid
+import weakref
+from functools import lru_cache
+from concurrent.futures import CancelledError, ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
 from pathlib import Path
 import re
 from datetime import datetime
 from app.services.s3_service import s3_service
+from app.services.render_worker import preimport_manim, render_scene, tex_cache_lock
 from config import settings
 
 logger = logging.getLogger(__name__)
 
+# Warm pool of render processes with Manim already imported.
+# Created lazily so importing this module (API, Celery master) stays cheap.
+_executor: ProcessPoolExecutor | None = None
+_executor_lock = threading.Lock()
+# Pools torn down on purpose; renders lost with them were not at fault
+_retired_executors: weakref.WeakSet = weakref.WeakSet()
+# Queue each pool's workers report their pid on, from the pool initializer
+_worker_pid_queues: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+# One render per worker at a time; see _run_render
+_render_slots = threading.BoundedSemaphore(settings.MANIM_WORKERS)
+# One Tex cache prune at a time, at most every _TEX_PRUNE_INTERVAL seconds once it ran
+_tex_prune_lock = threading.Lock()
+_last_tex_prune = float("-inf")
+_TEX_PRUNE_INTERVAL = 60
+# Attempts to get a render through pools other jobs keep tearing down
+_MAX_RENDER_SUBMISSIONS = 5
+
+# Patterns used to pull the root cause out of Manim's stderr, compiled once
+_ANSI_ESCAPE_RE = re.compile(r'\x1b\[[0-9;]*[mGKH]')
+_EXCEPTION_RE = re.compile(r'(?:[a-zA-Z_][a-zA-Z0-9_.]*Error|Exception):\s+.+')
+_ERROR_LINE_RE = re.compile(r'^[a-zA-Z_][a-zA-Z0-9_.]*Error:')
+_RICH_TRACEBACK_LINE_RE = re.compile(r'❱\s*(\d+)\s*│.*?│\s*(.+?)(?:\n|$)')
+_BOX_CHARS_RE = re.compile(r'[│╭╮╯╰─]')
+# Traceback frame inside a generated script, with the source line under it
+_SCRIPT_FRAME_RE = re.compile(
+    r'File "[^"]*' + re.escape(settings.GENERATED_DIR.name) + r'[/\\][^"]+\.py", line (\d+)[^\n]*\n[ \t]*(\S[^\n]*)'
+)
+
+# Scene class the system prompt asks for, preferred whenever it is defined
+DEFAULT_SCENE_NAME = "GeneratedAnimation"
+
+# Output sub-directory Manim uses for each quality preset
+QUALITY_DIRS = {
+    "low_quality": "480p15",
+    "medium_quality": "720p30",
+    "high_quality": "1080p60",
+    "production_quality": "1440p60",
+    "fourk_quality": "2160p60",
+}
+
 
 class RenderError(Exception):
     """Custom exception for rendering errors."""
@@ -34,15 +86,19 @@ def extract_error_details(stderr: str) -> str:
         return "Unknown error occurred during rendering"
     
     # 1. Remove ANSI escape sequences (colors, cursor movements, etc)
-    ansi_escape = re.compile(r'\x1b\[[0-9;]*[mGKH]')
-    clean_stderr = ansi_escape.sub('', stderr)
+    clean_stderr = _ANSI_ESCAPE_RE.sub('', stderr)
     
     # 2. Look for explicit Python exceptions (best quality)
     # We want the LAST one as that's usually the root cause in a traceback
-    exception_pattern = r'(?:[a-zA-Z_][a-zA-Z0-9_.]*Error|Exception):\s+.+'
-    exceptions = re.findall(exception_pattern, clean_stderr)
+    exceptions = _EXCEPTION_RE.findall(clean_stderr)
     
     if exceptions:
+        # Point the fix at the generated line the error came through; the
+        # deeper Manim frames mean nothing to the model
+        frames = _SCRIPT_FRAME_RE.findall(clean_stderr)
+        if frames:
+            line_num, code_line = frames[-1]
+            return f"{exceptions[-1].strip()}\nFailing line {line_num}: {code_line.strip()}"
         return exceptions[-1].strip()
 
     # 3. Look for explicit Python exceptions at the VERY END of the output
@@ -51,20 +107,19 @@ def extract_error_details(stderr: str) -> str:
     if clean_lines:
         # Check the last few lines for Error: patterns
         for line in reversed(clean_lines[-5:]): # Check last 5 lines
-            if re.match(r'^[a-zA-Z_][a-zA-Z0-9_.]*Error:', line):
+            if _ERROR_LINE_RE.match(line):
                 return line
             if "Exception:" in line:
                 return line
 
     # 4. Fallback: Try to find error within the traceback context if possible
     # Rich traceback format: │ ❱  31 │   │   ).move_to(embedding_block.center)
-    line_pattern = r'❱\s*(\d+)\s*│.*?│\s*(.+?)(?:\n|$)'
-    line_match = re.search(line_pattern, clean_stderr)
+    line_match = _RICH_TRACEBACK_LINE_RE.search(clean_stderr)
     
     if line_match:
         line_num = line_match.group(1)
         code_line = line_match.group(2).strip()
-        code_line = re.sub(r'[│╭╮╯╰─]', '', code_line).strip()
+        code_line = _BOX_CHARS_RE.sub('', code_line).strip()
         return f"Error near line {line_num}: {code_line}"
 
     # 5. Last resort: Return the last non-empty line of the output
@@ -74,10 +129,37 @@ def extract_error_details(stderr: str) -> str:
     return "Unknown error occurred during rendering"
 
 
-def get_generated_code() -> str:
-    """Read the currently generated animation code."""
+def extract_scene_class_name(tree: ast.Module) -> str:
+    """
+    Find the name of the Scene subclass defined in generated code.
+    
+    A scene can derive from a helper base defined in the same file, and the
+    file can define helper classes (mobjects) too, so the bases say little.
+    The class the system prompt asks for wins; otherwise the last top-level
+    class that defines construct() is the one meant to be rendered.
+    
+    Args:
+        tree: Parsed generated code
+    
+    Returns:
+        The class name, or DEFAULT_SCENE_NAME if no scene class is found
+    """
+    classes = [node for node in tree.body if isinstance(node, ast.ClassDef)]
+    if any(node.name == DEFAULT_SCENE_NAME for node in classes):
+        return DEFAULT_SCENE_NAME
+    
+    for node in reversed(classes):
+        if any(
+            isinstance(item, (ast.FunctionDef, ast.AsyncFunctionDef)) and item.name == "construct"
+            for item in node.body
+        ):
+            return node.name
+    return DEFAULT_SCENE_NAME
+
+
+def get_generated_code(script_path: Path) -> str:
+    """Read a generated animation script."""
     try:
-        script_path = settings.GENERATED_DIR / "animation.py"
         if script_path.exists():
             return script_path.read_text()
     except Exception as e:
@@ -85,65 +167,414 @@ def get_generated_code() -> str:
     return ""
 
 
-def execute_manim() -> tuple[str, str]:
+def _get_executor() -> ProcessPoolExecutor:
+    """Get (or start) the shared render worker pool."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            # spawn instead of fork: Celery runs tasks on threads and Gemini
+            # uses gRPC, neither of which is fork-safe
+            mp_context = multiprocessing.get_context("spawn")
+            pid_queue = mp_context.SimpleQueue()
+            _executor = ProcessPoolExecutor(
+                max_workers=settings.MANIM_WORKERS,
+                mp_context=mp_context,
+                initializer=preimport_manim,
+                initargs=(str(settings.RENDER_MEDIA_DIR), pid_queue),
+                # Generated scenes can leak memory (caches, mobjects held by
+                # module globals), so long-lived workers are recycled
+                max_tasks_per_child=settings.MANIM_RENDERS_PER_WORKER or None,
+            )
+            _worker_pid_queues[_executor] = pid_queue
+            logger.info(f"Started Manim render pool with {settings.MANIM_WORKERS} workers")
+        return _executor
+
+
+def warm_render_pool():
+    """
+    Start every render worker ahead of the first job.
+
+    The pool only spawns a process when a task arrives and no worker is idle,
+    so without this the first MANIM_WORKERS renders each wait for a fresh
+    interpreter to import and warm Manim. Submitting one no-op per worker
+    spawns them all now; the warm-up runs in the background.
+    """
+    executor = _get_executor()
+    for _ in range(settings.MANIM_WORKERS):
+        executor.submit(os.getpid)
+
+
+def _terminate_workers(executor: ProcessPoolExecutor):
+    """Kill the worker processes of a pool, including any stuck on a render."""
+    pid_queue = _worker_pid_queues.pop(executor, None)
+    if pid_queue is None:
+        return
+    pids = set()
+    while not pid_queue.empty():
+        pids.add(pid_queue.get())
+    # Only children that are still alive: pids of recycled workers that
+    # were already reaped may belong to unrelated processes by now
+    for process in multiprocessing.active_children():
+        if process.pid in pids:
+            process.terminate()
+
+
+def _reset_executor(executor: ProcessPoolExecutor):
+    """
+    Tear down a render pool on purpose, killing any worker stuck on a render.
+    
+    Only the given pool is torn down: if another job already replaced it,
+    the new pool (and the renders running in it) is left alone.
+    """
+    global _executor
+    with _executor_lock:
+        if executor in _retired_executors:
+            return
+        _retired_executors.add(executor)
+        if _executor is executor:
+            _executor = None
+    # A timed-out render cannot be cancelled once running, so terminate the
+    # worker processes outright; the next render starts a fresh pool
+    _terminate_workers(executor)
+    executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _discard_broken_executor(executor: ProcessPoolExecutor):
+    """
+    Replace a pool that broke by itself, e.g. because a scene crashed a worker.
+    
+    The pool has already killed its other workers. It is not marked retired:
+    every job that lost a render with it may be the one that crashed it.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is executor:
+            _executor = None
+    _worker_pid_queues.pop(executor, None)
+    executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _run_render(code: str, *args) -> tuple[int, str, str, str]:
+    """
+    Run render_scene in the worker pool.
+    
+    A timeout can only be enforced by killing the pool, which also takes
+    down renders other jobs have running or queued in it. Those renders did
+    nothing wrong, so they are resubmitted to the fresh pool rather than
+    reported as render errors for the fix loop to "fix".
+    
+    A pool that breaks by itself takes every render in it down too, and any
+    of them may have been the one that crashed it. Each gets one more try;
+    a render whose second pool breaks as well fails, so a crashing scene
+    cannot keep killing other jobs' renders.
+    
+    At most MANIM_WORKERS renders are submitted at once, so a render never
+    waits in the pool's queue and RENDER_TIMEOUT only counts rendering.
+    """
+    crashed = False
+    with _render_slots:
+        for _ in range(_MAX_RENDER_SUBMISSIONS):
+            executor = _get_executor()
+            try:
+                future = executor.submit(render_scene, *args)
+            except BrokenProcessPool:
+                # A worker died while idle (e.g. OOM-killed, or its
+                # initializer failed) and nothing has replaced the pool yet
+                _discard_broken_executor(executor)
+                continue
+            except RuntimeError:
+                if executor is not _executor:
+                    # Shut down by another job between _get_executor() and submit()
+                    continue
+                raise
+            
+            try:
+                return future.result(timeout=settings.RENDER_TIMEOUT)
+            except FutureTimeoutError:
+                _reset_executor(executor)
+                raise RenderError(f"Rendering timed out after {settings.RENDER_TIMEOUT} seconds")
+            except (BrokenProcessPool, CancelledError):
+                if executor in _retired_executors:
+                    logger.info("Render pool was reset by another job, resubmitting render")
+                    continue
+                _discard_broken_executor(executor)
+                if crashed:
+                    # Crashing two fresh workers in a row is the scene's doing.
+                    # With stderr, the fix loop gets told what happened and
+                    # cached copies of the code are invalidated.
+                    raise RenderError(
+                        "Render worker crashed",
+                        stderr=(
+                            "RuntimeError: The render worker process crashed twice while rendering this scene "
+                            "(segfault or out of memory). Reduce the number of mobjects, points or frames, "
+                            "and avoid unbounded loops or very large arrays."
+                        ),
+                        code=code,
+                    )
+                crashed = True
+    
+    raise RenderError(f"Render pool failed {_MAX_RENDER_SUBMISSIONS} times in a row")
+
+
+def _collect_video(video_path: Path) -> Path:
+    """Move the finished video out of the scratch media dir into VIDEOS_DIR."""
+    scratch_videos_dir = (settings.RENDER_MEDIA_DIR / "videos").resolve()
+    if scratch_videos_dir == settings.VIDEOS_DIR.resolve():
+        return video_path
+    
+    # Keep Manim's {module_name}/{quality}/{scene}.mp4 layout
+    relative_path = video_path.resolve().relative_to(scratch_videos_dir)
+    target_path = settings.VIDEOS_DIR / relative_path
+    target_path.parent.mkdir(parents=True, exist_ok=True)
+    shutil.move(str(video_path), str(target_path))
+    return target_path
+
+
+def _evict_oldest(entries: list[os.DirEntry], max_bytes: int, last_used=lambda stat: stat.st_mtime):
+    """Delete the least recently used files until the rest fit in max_bytes."""
+    stats = [(entry.path, entry.stat()) for entry in entries]
+    total_size = sum(stat.st_size for _, stat in stats)
+    for path, stat in sorted(stats, key=lambda item: last_used(item[1])):
+        if total_size <= max_bytes:
+            break
+        total_size -= stat.st_size
+        # Another render thread may be pruning the same directory
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(path)
+
+
+def _tex_cache_entries() -> list[os.DirEntry]:
+    """Files in the shared Tex/ and texts/ caches."""
+    entries = []
+    for cache_dir in (settings.RENDER_MEDIA_DIR / "Tex", settings.RENDER_MEDIA_DIR / "texts"):
+        if cache_dir.is_dir():
+            with os.scandir(cache_dir) as it:
+                entries.extend(entry for entry in it if entry.is_file())
+    return entries
+
+
+def _prune_tex_cache():
+    """
+    Trim the shared Tex/ and texts/ caches to RENDER_TEX_CACHE_MAX_BYTES.
+    
+    Compiled LaTeX and rendered text are keyed by content, so every new
+    formula or label adds files. Manim checks a cache file exists and reads
+    it later, so nothing may be deleted while a render or worker warm-up
+    uses the cache: they hold its lock shared, and the prune only runs when
+    it can take the lock exclusively without waiting, i.e. no render is in
+    flight. Until it gets that chance it is retried after every render; once
+    it has run it waits _TEX_PRUNE_INTERVAL seconds.
+    """
+    global _last_tex_prune
+    if settings.RENDER_TEX_CACHE_MAX_BYTES <= 0:
+        return
+    # Another thread is already pruning
+    if not _tex_prune_lock.acquire(blocking=False):
+        return
+    try:
+        if time.monotonic() - _last_tex_prune < _TEX_PRUNE_INTERVAL:
+            return
+        
+        # Measuring only reads; files a render adds meanwhile are counted next time
+        if sum(entry.stat().st_size for entry in _tex_cache_entries()) <= settings.RENDER_TEX_CACHE_MAX_BYTES:
+            _last_tex_prune = time.monotonic()
+            return
+        
+        with tex_cache_lock(str(settings.RENDER_MEDIA_DIR), exclusive=True):
+            # Cache hits only read a file, so mtime is creation order; atime
+            # (relatime: refreshed on the first read after a write, then daily)
+            # keeps entries like the warmed LaTeX preamble from going first
+            _evict_oldest(
+                _tex_cache_entries(),
+                settings.RENDER_TEX_CACHE_MAX_BYTES,
+                last_used=lambda stat: max(stat.st_atime, stat.st_mtime),
+            )
+        _last_tex_prune = time.monotonic()
+    except BlockingIOError:
+        # A render is using the cache; try again after the next one
+        pass
+    except OSError as e:
+        logger.warning(f"Could not prune the Tex cache: {e}")
+    finally:
+        _tex_prune_lock.release()
+
+
+def _discard_scratch(script_path: Path):
+    """
+    Remove a job's files from the scratch media dir and bound its shared caches.
+    
+    RENDER_MEDIA_DIR is usually tmpfs, so whatever is left there holds RAM
+    for as long as the worker lives.
+    """
+    scratch_dir = settings.RENDER_MEDIA_DIR
+    try:
+        # Partial movies, and the whole output of a failed render. Without a
+        # separate scratch dir, videos/ is where finished renders are kept.
+        if (scratch_dir / "videos").resolve() != settings.VIDEOS_DIR.resolve():
+            shutil.rmtree(scratch_dir / "videos" / script_path.stem, ignore_errors=True)
+        # Still frames written by scenes that never call self.play()
+        shutil.rmtree(scratch_dir / "images" / script_path.stem, ignore_errors=True)
+    except OSError as e:
+        logger.warning(f"Could not clean up render scratch files: {e}")
+    
+    _prune_tex_cache()
+
+
+@lru_cache(maxsize=1)
+def _get_renderer() -> str:
+    """Resolve settings.MANIM_RENDERER, detecting a GPU for "auto"."""
+    renderer = settings.MANIM_RENDERER.lower()
+    if renderer == "auto":
+        has_gpu = Path("/dev/nvidia0").exists() or Path("/dev/dri/renderD128").exists()
+        renderer = "opengl" if has_gpu else "cairo"
+        logger.info(f"Using the {renderer} Manim renderer")
+    return renderer
+
+
+def _video_cache_path(code: str, scene_name: str, quality: str) -> Path:
+    """Location of the cached render for this exact code, quality and renderer."""
+    digest = hashlib.blake2b(
+        "\0".join([code, scene_name, quality, _get_renderer()]).encode("utf-8"), digest_size=16
+    ).hexdigest()
+    return settings.VIDEO_CACHE_DIR / f"{digest}.mp4"
+
+
+def _link_or_copy(source: Path, target: Path):
+    """Hard-link source to target, copying if they are on different filesystems."""
+    target.parent.mkdir(parents=True, exist_ok=True)
+    target.unlink(missing_ok=True)
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copy2(source, target)
+
+
+def _restore_cached_video(cache_path: Path, script_path: Path, scene_name: str, quality: str) -> Path | None:
+    """Put a cached render where Manim would have written it, if there is one."""
+    quality_dir = QUALITY_DIRS.get(quality)
+    if quality_dir is None:
+        # Unknown preset: let Manim render it (and report it) instead
+        return None
+    try:
+        target_path = settings.VIDEOS_DIR / script_path.stem / quality_dir / f"{scene_name}.mp4"
+        _link_or_copy(cache_path, target_path)
+        # mtime marks the entry as recently used for eviction
+        os.utime(cache_path)
+        return target_path
+    except FileNotFoundError:
+        return None
+    except OSError as e:
+        logger.warning(f"Could not reuse cached video: {e}")
+        return None
+
+
+def _store_cached_video(video_path: Path, cache_path: Path):
+    """Keep a finished render for identical code and evict the oldest entries."""
+    try:
+        _link_or_copy(video_path, cache_path)
+        
+        with os.scandir(settings.VIDEO_CACHE_DIR) as it:
+            entries = [entry for entry in it if entry.name.endswith(".mp4")]
+        _evict_oldest(entries, settings.VIDEO_CACHE_MAX_BYTES)
+    except OSError as e:
+        # The cache is an optimisation; the render itself succeeded
+        logger.warning(f"Could not cache rendered video: {e}")
+
+
+def execute_manim(script_path: Path, quality: str | None = None) -> tuple[str, str, Path]:
     """
     Execute manim to render the generated animation.
     
+    The render runs in a pre-warmed worker process, so the Manim import cost
+    is paid once per worker rather than once per render.
+    
+    Args:
+        script_path: Per-job generated script to render
+        quality: Manim quality preset, defaults to settings.PREVIEW_QUALITY
+    
     Returns:
-        tuple: (stdout, stderr) from the manim process
+        tuple: (stdout, stderr, video_path) from the render
         
     Raises:
         RenderError: If rendering fails
     """
     try:
-        script_path = settings.GENERATED_DIR / "animation.py"
-        
         if not script_path.exists():
             raise RenderError("Animation script not found")
         
-        logger.info("Starting Manim rendering...")
+        quality = quality or settings.PREVIEW_QUALITY
+        code = get_generated_code(script_path)
         
-        # Run manim command using current python executable
-        result = subprocess.run(
-            [
-                sys.executable, "-m", "manim",
+        # A syntax error needs no render worker to find; report it the way a
+        # render would so it goes straight back to the fix loop
+        try:
+            tree = ast.parse(code, filename=str(script_path))
+        except SyntaxError as e:
+            stderr = "".join(traceback.format_exception_only(type(e), e))
+            logger.error(f"Generated code does not parse: {e}")
+            raise RenderError("Generated code has a syntax error", stderr=stderr, code=code)
+        
+        scene_name = extract_scene_class_name(tree)
+        
+        # Identical code renders to an identical video
+        cache_path = None
+        if settings.VIDEO_CACHE_MAX_BYTES > 0:
+            cache_path = _video_cache_path(code, scene_name, quality)
+            video_path = _restore_cached_video(cache_path, script_path, scene_name, quality)
+            if video_path:
+                logger.info(f"Reusing cached render {cache_path.name}")
+                return "", "", video_path
+        
+        logger.info(f"Starting Manim rendering of {scene_name} ({quality})...")
+        
+        try:
+            returncode, stdout, stderr, video_path = _run_render(
+                code,
                 str(script_path),
-                "GeneratedAnimation",
-                "-qm",  # Medium quality (720p 30fps) for better compatibility
-                "--media_dir", str(settings.MEDIA_DIR),
-                "--format", "mp4"
-            ],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            stdin=subprocess.DEVNULL,
-            text=True,
-            timeout=300  # 5 minute timeout
-        )
-        
-        stdout = result.stdout
-        stderr = result.stderr
-        
-        if result.returncode != 0:
-            error_msg = f"Manim rendering failed with code {result.returncode}"
-            logger.error(f"{error_msg}\nSTDERR: {stderr}")
-            # Include stderr and current code in the exception for retry logic
-            current_code = get_generated_code()
-            raise RenderError(error_msg, stderr=stderr, code=current_code)
+                scene_name,
+                str(settings.RENDER_MEDIA_DIR),
+                quality,
+                _get_renderer(),
+            )
+            
+            if returncode != 0:
+                error_msg = f"Manim rendering failed with code {returncode}"
+                logger.error(f"{error_msg}\nSTDERR: {stderr}")
+                # Include stderr and current code in the exception for retry logic
+                raise RenderError(error_msg, stderr=stderr, code=code)
+            
+            # The worker reports the exact output file, so nothing has to be
+            # looked up or waited for on disk afterwards
+            if not video_path or not Path(video_path).is_file():
+                # e.g. a scene without self.play() only writes a still image
+                raise RenderError(
+                    "No video file generated",
+                    stderr="RuntimeError: The scene rendered no video. construct() must play at least one animation with self.play().",
+                    code=code
+                )
+            video_path = _collect_video(Path(video_path))
+        finally:
+            _discard_scratch(script_path)
+        if cache_path:
+            _store_cached_video(video_path, cache_path)
         
         logger.info("Manim rendering completed successfully")
-        return stdout, stderr
+        return stdout, stderr, video_path
         
-    except subprocess.TimeoutExpired:
-        raise RenderError("Rendering timed out after 5 minutes")
+    except RenderError:
+        raise
     except Exception as e:
         logger.error(f"Rendering error: {str(e)}")
         raise RenderError(f"Rendering failed: {str(e)}")
 
 
-def get_video_url() -> str:
+def get_video_url(video_path: Path) -> str:
     """
     Get the URL of the rendered video, uploading to S3 if configured.
     
+    Args:
+        video_path: Video reported by execute_manim
+    
     Returns:
         str: URL to access the video (local or S3)
         
@@ -151,22 +582,9 @@ def get_video_url() -> str:
         RenderError: If video file not found or upload fails
     """
     try:
-        # Find the most recent video file
-        # Default manim output structure: media/videos/{module_name}/{quality}/{scene_name}.mp4
-        # We invoke manim on "generated/animation.py" so module name is "animation"
-        # We use -qm so quality is "720p30"
-        videos_dir = settings.VIDEOS_DIR / "animation" / "720p30"
-        
-        if not videos_dir.exists():
-            raise RenderError("Video output directory not found")
-        
-        video_files = list(videos_dir.glob("*.mp4"))
-        
-        if not video_files:
-            raise RenderError("No video file generated")
-        
-        # Get most recent file
-        latest_video = max(video_files, key=lambda p: p.stat().st_mtime)
+        # execute_manim takes the path from Manim's file writer and checks it
+        # exists, so there is no output directory to search
+        latest_video = video_path
         logger.info(f"Found video file: {latest_video}")
         
         # Upload to S3 if enabled
@@ -183,12 +601,61 @@ def get_video_url() -> str:
 
             return video_url
         else:
-            # Return local URL
-            relative_path = latest_video.relative_to(settings.MEDIA_DIR)
-            video_url = f"/videos/{relative_path}".replace("\\", "/")
+            # Return local URL; /videos is mounted on VIDEOS_DIR
+            relative_path = latest_video.resolve().relative_to(settings.VIDEOS_DIR.resolve())
+            video_url = f"/videos/{relative_path.as_posix()}"
             
             return video_url
         
     except Exception as e:
         logger.error(f"Error getting video URL: {str(e)}")
-        raise RenderError(f"Failed to get video URL: {str(e)}")
\ No newline at end of file
+        raise RenderError(f"Failed to get video URL: {str(e)}")
+
+
+def local_video_path(video_url: str) -> Path | None:
+    """
+    Map a local /videos/ URL back to its file under VIDEOS_DIR.
+    
+    URLs stored before they were made relative to VIDEOS_DIR carry an extra
+    "videos/" segment, which is dropped.
+    
+    Returns:
+        The resolved file path, or None for other URLs and for paths that
+        would escape VIDEOS_DIR
+    """
+    if not video_url.startswith("/videos/"):
+        return None
+    
+    relative_path = video_url[len("/videos/"):]
+    # Render modules are named after job ids, never "videos"
+    if relative_path.startswith("videos/"):
+        relative_path = relative_path[len("videos/"):]
+    
+    videos_dir = settings.VIDEOS_DIR.resolve()
+    file_path = (videos_dir / relative_path).resolve()
+    if not file_path.is_relative_to(videos_dir):
+        return None
+    return file_path
+
+
+def delete_local_video(video_url: str):
+    """
+    Delete a local video and the per-job directories it leaves empty.
+    
+    Videos sit at VIDEOS_DIR/{module_name}/{quality}/{scene}.mp4, so removing
+    only the file would leave a directory per superseded render behind.
+    """
+    file_path = local_video_path(video_url)
+    if file_path is None:
+        return
+    
+    file_path.unlink(missing_ok=True)
+    videos_dir = settings.VIDEOS_DIR.resolve()
+    for directory in file_path.parents:
+        if directory == videos_dir:
+            break
+        try:
+            directory.rmdir()
+        except OSError:
+            # Not empty: another video still lives here
+            break
@@ -0,0 +1,120 @@
+"""Code that runs inside the Manim render worker processes.
+
+Kept free of app-level imports (settings, S3, Prisma) so spawning a worker only
+pays for Manim itself.
+"""
+import collections
+import contextlib
+import fcntl
+import importlib.util
+import io
+import linecache
+import os
+import traceback
+from pathlib import Path
+
+# Manim logs every animation; the retry loop only needs the end of the output
+OUTPUT_TAIL_CHARS = 64 * 1024
+
+# Lock file in the media dir guarding its shared Tex/ and texts/ caches.
+# Renders and warm-ups hold it shared; a prune only runs if it can take
+# it exclusively right away, so nothing ever waits for a prune.
+TEX_CACHE_LOCK = ".tex-cache.lock"
+
+
+@contextlib.contextmanager
+def tex_cache_lock(media_dir: str, exclusive: bool = False):
+    """
+    Hold the media dir's Tex cache lock across processes.
+
+    Raises:
+        BlockingIOError: If exclusive and the lock is held by anyone
+    """
+    with open(Path(media_dir) / TEX_CACHE_LOCK, "a") as lock:
+        if exclusive:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            fcntl.flock(lock, fcntl.LOCK_SH)
+        # Closing the file releases the lock
+        yield
+
+
+def preimport_manim(media_dir: str | None = None, pid_queue=None):
+    """
+    Pool initializer: import Manim (numpy, cairo, pango...) once per worker.
+
+    With a media_dir, also render a throwaway MathTex, Tex and Text so the
+    LaTeX preamble, the SVG cache under media_dir/Tex and the font caches are
+    built before the first job needs them. With a pid_queue, the worker's pid
+    is reported on it so the parent can kill the worker if a render hangs.
+    """
+    if pid_queue is not None:
+        pid_queue.put(os.getpid())
+
+    import manim
+
+    if media_dir is None:
+        return
+    # Warming is best effort; a missing LaTeX install shows up in renders
+    with contextlib.suppress(Exception), tex_cache_lock(media_dir):
+        with manim.tempconfig({"media_dir": media_dir}):
+            manim.MathTex(r"x + y")
+            manim.Tex("warm")
+            manim.Text("warm")
+
+
+def render_scene(
+    script_path: str, scene_name: str, media_dir: str, quality: str, renderer: str = "cairo"
+) -> tuple[int, str, str, str]:
+    """
+    Render a scene from a generated script inside the current process.
+
+    Args:
+        script_path: Path to the generated animation script
+        scene_name: Name of the Scene subclass to render
+        media_dir: Manim media directory
+        quality: Manim quality preset, e.g. "low_quality" (480p15)
+        renderer: "cairo" or "opengl"
+
+    Returns:
+        tuple: (returncode, stdout, stderr, video_path); video_path is ""
+        when the render failed
+    """
+    from manim import tempconfig
+
+    stdout = _TailBuffer()
+    stderr = _TailBuffer()
+    returncode = 0
+    video_path = ""
+
+    with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr), tex_cache_lock(media_dir):
+        try:
+            # tempconfig restores the global Manim config afterwards, so
+            # consecutive renders in the same worker do not leak settings
+            with tempconfig({
+                "input_file": script_path,
+                "media_dir": media_dir,
+                "quality": quality,
+                "format": "mp4",
+                "progress_bar": "none",
+                "renderer": renderer,
+                # The OpenGL renderer only writes a movie when asked to
+                "write_to_movie": True,
+            }):
+                # Name the module after the per-job script so tracebacks and
+                # Manim's output dir agree on which job they belong to
+                spec = importlib.util.spec_from_file_location(Path(script_path).stem, script_path)
+                module = importlib.util.module_from_spec(spec)
+                spec.loader.exec_module(module)
+                scene = getattr(module, scene_name)()
+                scene.render()
+                video_path = str(scene.renderer.file_writer.movie_file_path)
+        except Exception:
+            traceback.print_exc()
+            returncode = 1
+        finally:
+            # The traceback cached the script's source lines; per-job scripts
+            # are never seen again, so don't let a long-lived worker keep them
+            linecache.cache.pop(script_path, None)
+
+    return returncode, stdout.getvalue(), stderr.getvalue(), video_path
@@ -133,6 +133,46 @@ class S3StorageService:
             logger.error(f"Failed to delete from S3: {str(e)}")
             return False
     
+    def delete_videos(self, s3_keys: list[str]) -> bool:
+        """
+        Delete several videos from S3 with batched requests.
+        
+        Args:
+            s3_keys: S3 object keys
+            
+        Returns:
+            True if all were deleted successfully
+        """
+        if not self.enabled:
+            return all([self.delete_video(s3_key) for s3_key in s3_keys])
+        
+        # DeleteObjects accepts up to 1000 keys per request. Every batch is
+        # attempted even if an earlier one failed.
+        failed = 0
+        for start in range(0, len(s3_keys), 1000):
+            batch = s3_keys[start:start + 1000]
+            try:
+                response = self.s3_client.delete_objects(
+                    Bucket=self.bucket_name,
+                    Delete={
+                        'Objects': [{'Key': key} for key in batch],
+                        'Quiet': True
+                    }
+                )
+            except ClientError as e:
+                logger.error(f"Failed to delete {len(batch)} videos from S3: {str(e)}")
+                failed += len(batch)
+                continue
+            for error in response.get('Errors', []):
+                logger.error(f"Failed to delete from S3: {error.get('Key')}: {error.get('Message')}")
+            failed += len(response.get('Errors', []))
+        
+        if failed:
+            logger.error(f"Failed to delete {failed} of {len(s3_keys)} videos from S3")
+            return False
+        logger.info(f"Deleted {len(s3_keys)} videos from S3")
+        return True
+    
     def list_videos(self, prefix: str = "", max_keys: int = 100) -> list[dict]:
         """
         List videos in S3 bucket.
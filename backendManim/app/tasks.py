@@ -1,65 +1,204 @@
 import logging
 from app.celery_app import celery_app
 from app.services.ai_service import (
-    generate_code, save_code, fix_code,
+    generate_code, save_code, discard_code, fix_code, sanitize_code, remember_code, idle_gemini_slots,
     CodeGenerationError, SecurityViolationError, MAX_RETRY_ATTEMPTS
 )
-from app.services.render_service import execute_manim, get_video_url, RenderError, extract_error_details
+from app.services.render_service import (
+    execute_manim, get_video_url, delete_local_video, RenderError, extract_error_details, warm_render_pool
+)
 from app.services.database_service import db_service
+from app.services.cache_service import cache_service
+from app.services.s3_service import s3_service
+from celery.concurrency.prefork import TaskPool as PreforkPool
+from celery.signals import worker_process_init, worker_ready, worker_shutdown
+import ast
 import asyncio
-from app.core.config import settings
+import contextlib
+import threading
+import redis
+from config import settings
 
 logger = logging.getLogger(__name__)
 
 
+# One event loop per worker process, shared by all task threads, so the
+# Prisma connection (and its query engine) outlives individual tasks.
+_loop: asyncio.AbstractEventLoop | None = None
+_loop_lock = threading.Lock()
+
+
+def _get_loop() -> asyncio.AbstractEventLoop:
+    """Get (or start) the worker's background event loop."""
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="db-event-loop", daemon=True).start()
+        return _loop
+
+
 def run_async(coro):
     """Helper to run async functions in sync Celery tasks."""
+    return asyncio.run_coroutine_threadsafe(coro, _get_loop()).result()
+
+
+# Marks jobs with an upgrade render queued or running. The task releases it
+# when it finishes; the expiry only covers a worker dying first. A queued task
+# can wait behind other renders for a while, so the claim outlives a few job
+# timeouts and is renewed for one job timeout once the task starts.
+_UPGRADE_QUEUED_TTL = max(settings.JOB_TIMEOUT * 6, 3600)
+_UPGRADE_RUNNING_TTL = settings.JOB_TIMEOUT + 60
+_redis = redis.Redis.from_url(settings.REDIS_URL)
+
+
+def claim_upgrade(job_id: str) -> bool:
+    """Mark a job as upgrading; False if an upgrade is already pending for it."""
+    return bool(_redis.set(f"manim:upgrade:{job_id}", 1, nx=True, ex=_UPGRADE_QUEUED_TTL))
+
+
+def _renew_upgrade(job_id: str):
+    """Hold a job's upgrade claim for as long as its task can run."""
+    _redis.set(f"manim:upgrade:{job_id}", 1, ex=_UPGRADE_RUNNING_TTL)
+
+
+def release_upgrade(job_id: str):
+    """Allow another upgrade of a job to be queued."""
+    _redis.delete(f"manim:upgrade:{job_id}")
+
+
+@worker_ready.connect
+def _warm_render_pool(sender=None, **kwargs):
+    """Spawn the Manim render processes before the first job arrives."""
+    # Prefork runs tasks in child processes, which start their own render
+    # pool; one spawned here would sit unused in the parent
+    if isinstance(getattr(sender, "pool", None), PreforkPool):
+        return
+    warm_render_pool()
+
+
+@worker_process_init.connect
+def _warm_child_render_pool(**kwargs):
+    """Spawn a prefork child's render processes before its first job arrives."""
+    warm_render_pool()
+
+
+@worker_shutdown.connect
+def _disconnect_db(**kwargs):
+    """Close the shared database connection when the worker stops."""
+    if _loop is not None:
+        run_async(db_service.disconnect())
+
+
+async def _report_status(self_task, task_id: str, state: str, status: str, meta: dict = None):
+    """Publish a job's progress to the Celery result backend and the database."""
+    await asyncio.gather(
+        asyncio.to_thread(self_task.update_state, task_id=task_id, state=state, meta=meta),
+        db_service.update_job_status(task_id, status),
+    )
+
+
+async def _run_while_reporting(work, status):
+    """
+    Run a pipeline step while its status update is written.
+    
+    The status write does not depend on the step, so its round trips overlap
+    with the Gemini call or render instead of delaying it.
+    """
+    result, status_result = await asyncio.gather(work, status, return_exceptions=True)
+    if isinstance(result, BaseException):
+        raise result
+    if isinstance(status_result, BaseException):
+        raise status_result
+    return result
+
+
+async def _race_fixes(**fix_kwargs) -> str:
+    """
+    Request fixes at several temperatures at once and take the first usable one.
+    
+    Trades extra tokens for tail latency: a candidate that parses is returned
+    as soon as it arrives. If none parses, the first one that came back is
+    used so its syntax error reaches the next fix round.
+    
+    Each extra candidate is a full FIX_MODEL_NAME request that is billed even
+    when it loses, and a losing call cannot be interrupted: it holds its
+    Gemini slot until it completes. Extra candidates are therefore only sent
+    while slots are idle, so they never make other jobs' calls wait.
+    
+    Raises:
+        CodeGenerationError, SecurityViolationError: If every candidate failed
+    """
+    temperatures = settings.FIX_CANDIDATE_TEMPERATURES or [None]
+    # The first candidate takes a slot (or waits for one) like any other call
+    extra = min(len(temperatures) - 1, max(idle_gemini_slots() - 1, 0))
+    candidates = [
+        asyncio.create_task(asyncio.to_thread(fix_code, temperature=temperature, **fix_kwargs))
+        for temperature in temperatures[:1 + extra]
+    ]
+    fallback = None
+    first_error = None
     try:
-        loop = asyncio.get_event_loop()
-    except RuntimeError:
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
+        for next_done in asyncio.as_completed(candidates):
+            try:
+                code = await next_done
+            except (CodeGenerationError, SecurityViolationError) as e:
+                first_error = first_error or e
+                continue
+            try:
+                ast.parse(code)
+                return code
+            except SyntaxError:
+                fallback = fallback or code
+    finally:
+        # Threads cannot be interrupted; losers finish in the background
+        for candidate in candidates:
+            candidate.cancel()
     
-    if loop.is_closed():
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        
-    return loop.run_until_complete(coro)
+    if fallback is not None:
+        return fallback
+    raise first_error
 
 
 async def process_job_async(task_id: str, prompt: str, self_task, api_key: str = None):
-    """Async handler for the animation job with self-healing retry mechanism."""
+    """
+    Async handler for the animation job with self-healing retry mechanism.
+    
+    Gemini calls, file writes and renders are blocking, so they run in worker
+    threads and the event loop stays free for the database I/O.
+    """
     code = None
     last_error = None
+    # One script per job: concurrent jobs in the same worker must not render
+    # each other's code, and Manim names the output dir after the script
+    script_path = settings.GENERATED_DIR / f"{task_id}.py"
     
     try:
-        # Connect to DB locally for this task
+        # Connects on the worker's first task; later tasks reuse the connection
         await db_service.connect()
         
-        # Update status: Generating code
-        self_task.update_state(state='GENERATING_CODE')
-        await db_service.update_job_status(task_id, 'generating_code')
-        logger.info(f"[Task {task_id}] Generating code...")
-        
         # Generate initial code
-        code = generate_code(prompt, api_key)
-        save_code(code)
+        logger.info(f"[Task {task_id}] Generating code...")
+        code = await _run_while_reporting(
+            asyncio.to_thread(generate_code, prompt, api_key),
+            _report_status(self_task, task_id, 'GENERATING_CODE', 'generating_code'),
+        )
+        await asyncio.to_thread(save_code, code, script_path)
         logger.info(f"[Task {task_id}] Code generated successfully")
         
         # Attempt rendering with retry loop
         for attempt in range(1, MAX_RETRY_ATTEMPTS + 1):
             try:
-                # Update status: Rendering
-                self_task.update_state(state='RENDERING', meta={'attempt': attempt})
+                # Execute Manim
                 status_msg = f'rendering' if attempt == 1 else f'rendering (retry {attempt}/{MAX_RETRY_ATTEMPTS})'
-                await db_service.update_job_status(task_id, status_msg)
                 logger.info(f"[Task {task_id}] Rendering animation (attempt {attempt}/{MAX_RETRY_ATTEMPTS})...")
-                
-                # Execute Manim
-                stdout, stderr = execute_manim()
+                stdout, stderr, video_path = await _run_while_reporting(
+                    asyncio.to_thread(execute_manim, script_path),
+                    _report_status(self_task, task_id, 'RENDERING', status_msg, {'attempt': attempt}),
+                )
                 
                 # If we get here, rendering succeeded!
-                video_url = get_video_url()
+                video_url = await asyncio.to_thread(get_video_url, video_path)
                 execution_log = f"STDOUT:\n{stdout}\n\nSTDERR:\n{stderr}"
                 if attempt > 1:
                     execution_log = f"Successfully rendered after {attempt} attempts.\n\n{execution_log}"
@@ -73,9 +212,33 @@ async def process_job_async(task_id: str, prompt: str, self_task, api_key: str =
                     video_url=video_url,
                     execution_log=execution_log,
                     generated_code=code,
-                    s3_key=s3_key
+                    s3_key=s3_key,
+                    quality=settings.PREVIEW_QUALITY
                 )
                 
+                # Only code that actually rendered is worth serving again
+                await asyncio.to_thread(remember_code, prompt, code, api_key)
+                
+                if settings.AUTO_UPGRADE_QUALITY:
+                    # The preview is already playable; the full-quality video
+                    # replaces it when the background render finishes. The job
+                    # is complete either way, so a failure here is only logged.
+                    claimed = False
+                    try:
+                        claimed = await asyncio.to_thread(claim_upgrade, task_id)
+                        if claimed:
+                            await asyncio.to_thread(
+                                upgrade_animation_quality.apply_async,
+                                args=[task_id, code, settings.UPGRADE_QUALITY],
+                                time_limit=settings.JOB_TIMEOUT,
+                                soft_time_limit=settings.JOB_SOFT_TIMEOUT
+                            )
+                    except Exception as e:
+                        logger.warning(f"[Task {task_id}] Could not queue quality upgrade: {str(e)}")
+                        if claimed:
+                            with contextlib.suppress(redis.RedisError):
+                                await asyncio.to_thread(release_upgrade, task_id)
+                
                 logger.info(f"[Task {task_id}] Completed successfully! Video: {video_url}")
                 return {
                     'status': 'completed',
@@ -89,11 +252,16 @@ async def process_job_async(task_id: str, prompt: str, self_task, api_key: str =
                 error_details = extract_error_details(render_error.stderr)
                 logger.warning(f"[Task {task_id}] Render attempt {attempt} failed: {error_details[:200]}...")
                 
+                if attempt == 1 and render_error.stderr:
+                    # The first draft may have been served from the code cache.
+                    # Only errors raised by the scene itself carry stderr;
+                    # timeouts and crashed or overloaded workers say nothing
+                    # about whether the code is bad.
+                    await asyncio.to_thread(cache_service.invalidate_code, code)
+                
                 # Check if we have more attempts
                 if attempt < MAX_RETRY_ATTEMPTS:
                     # Try to fix the code
-                    self_task.update_state(state='FIXING_CODE', meta={'attempt': attempt})
-                    await db_service.update_job_status(task_id, f'fixing_code (attempt {attempt + 1}/{MAX_RETRY_ATTEMPTS})')
                     logger.info(f"[Task {task_id}] Attempting to fix code...")
                     
                     try:
@@ -101,20 +269,28 @@ async def process_job_async(task_id: str, prompt: str, self_task, api_key: str =
                         failed_code = render_error.code if render_error.code else code
                         
                         # Ask AI to fix the code
-                        code = fix_code(
-                            original_prompt=prompt,
-                            failed_code=failed_code,
-                            error_message=error_details,
-                            attempt=attempt + 1,
-                            api_key=api_key
+                        code = await _run_while_reporting(
+                            _race_fixes(
+                                original_prompt=prompt,
+                                failed_code=failed_code,
+                                error_message=error_details,
+                                attempt=attempt + 1,
+                                api_key=api_key
+                            ),
+                            _report_status(
+                                self_task, task_id, 'FIXING_CODE',
+                                f'fixing_code (attempt {attempt + 1}/{MAX_RETRY_ATTEMPTS})', {'attempt': attempt}
+                            ),
                         )
-                        save_code(code)
+                        await asyncio.to_thread(save_code, code, script_path)
                         logger.info(f"[Task {task_id}] Fixed code saved, retrying render...")
                         
                     except (CodeGenerationError, SecurityViolationError) as fix_error:
+                        # Transient Gemini errors were already retried with
+                        # backoff inside fix_code, and rendering the unchanged
+                        # code again would fail the same way
                         logger.error(f"[Task {task_id}] Failed to fix code: {fix_error}")
-                        # Continue to next attempt anyway with same code
-                        continue
+                        raise render_error from fix_error
                 else:
                     # Out of retries
                     logger.error(f"[Task {task_id}] All {MAX_RETRY_ATTEMPTS} render attempts failed")
@@ -127,8 +303,7 @@ async def process_job_async(task_id: str, prompt: str, self_task, api_key: str =
         # Re-raise to be caught in main task
         raise e
     finally:
-        # Always disconnect
-        await db_service.disconnect()
+        await asyncio.to_thread(discard_code, script_path)
 
 
 def _extract_s3_key(video_url: str) -> str | None:
@@ -168,23 +343,17 @@ def process_animation_job(self, prompt: str, api_key: str = None):
         
     except SecurityViolationError as e:
         logger.error(f"[Task {task_id}] Security violation: {str(e)}")
-        run_async(db_service.connect())
         run_async(db_service.update_job_error(task_id, f"Security violation: {str(e)}"))
-        run_async(db_service.disconnect())
         raise
         
     except CodeGenerationError as e:
         logger.error(f"[Task {task_id}] Code generation failed: {str(e)}")
-        run_async(db_service.connect())
         run_async(db_service.update_job_error(task_id, f"Code generation failed: {str(e)}"))
-        run_async(db_service.disconnect())
         raise
         
     except RenderError as e:
         logger.error(f"[Task {task_id}] Rendering failed: {str(e)}")
-        run_async(db_service.connect())
         run_async(db_service.update_job_error(task_id, f"Rendering failed: {str(e)}"))
-        run_async(db_service.disconnect())
         raise
         
     except Exception as e:
@@ -193,7 +362,79 @@ def process_animation_job(self, prompt: str, api_key: str = None):
         try:
             run_async(db_service.connect())
             run_async(db_service.update_job_error(task_id, f"Unexpected error: {str(e)}"))
-            run_async(db_service.disconnect())
         except Exception as db_err:
             logger.error(f"Failed to log error to DB: {str(db_err)}")
-        raise
\ No newline at end of file
+        raise
+
+async def _discard_video(video_url: str | None, s3_key: str | None):
+    """Delete a video file no job refers to any more."""
+    if s3_service.enabled:
+        if s3_key:
+            await asyncio.to_thread(s3_service.delete_video, s3_key)
+    elif video_url:
+        await asyncio.to_thread(delete_local_video, video_url)
+
+
+async def upgrade_job_async(task_id: str, job_id: str, code: str, quality: str, self_task):
+    """Re-render a completed job's code at a higher quality and swap in the video."""
+    script_path = settings.GENERATED_DIR / f"{job_id}_{quality}.py"
+    
+    try:
+        await db_service.connect()
+        job = await db_service.get_job(job_id)
+        if not job:
+            logger.info(f"[Task {job_id}] Job was deleted, skipping upgrade")
+            return {'status': 'skipped', 'quality': quality}
+        if job.get('quality') == quality:
+            # Upgrades are free, so each job gets at most one
+            logger.info(f"[Task {job_id}] Video is already at {quality}")
+            return {'status': 'skipped', 'video_url': job.get('videoUrl'), 'quality': quality}
+        
+        # Generated code is never rendered without the security check
+        await asyncio.to_thread(save_code, sanitize_code(code), script_path)
+        
+        logger.info(f"[Task {job_id}] Rendering at {quality}...")
+        stdout, stderr, video_path = await _run_while_reporting(
+            asyncio.to_thread(execute_manim, script_path, quality),
+            asyncio.to_thread(self_task.update_state, task_id=task_id, state='RENDERING', meta={'quality': quality}),
+        )
+        video_url = await asyncio.to_thread(get_video_url, video_path)
+        s3_key = _extract_s3_key(video_url)
+        
+        if await db_service.update_job_video(job_id, video_url, s3_key, quality) is None:
+            # The job was deleted during the render; nothing will serve the video
+            logger.info(f"[Task {job_id}] Job was deleted, discarding upgraded video")
+            await _discard_video(video_url, s3_key)
+            return {'status': 'skipped', 'quality': quality}
+        
+        # The preview is no longer referenced by the job
+        old_video_url = job.get('videoUrl')
+        if old_video_url != video_url:
+            await _discard_video(old_video_url, job.get('s3Key'))
+        
+        logger.info(f"[Task {job_id}] Upgraded to {quality}: {video_url}")
+        return {'status': 'completed', 'video_url': video_url, 'quality': quality}
+    finally:
+        await asyncio.to_thread(discard_code, script_path)
+
+
+@celery_app.task(bind=True, name="upgrade_animation_quality")
+def upgrade_animation_quality(self, job_id: str, code: str, quality: str = None):
+    """
+    Celery task entry point for re-rendering an accepted preview.
+    
+    The job keeps serving its preview until the new video is ready, so a
+    failed upgrade is logged but does not fail the job.
+    """
+    quality = quality or settings.UPGRADE_QUALITY
+    logger.info(f"[Task {job_id}] Upgrading video to {quality}")
+    
+    try:
+        # The claim may have expired while the task was queued
+        _renew_upgrade(job_id)
+        return run_async(upgrade_job_async(self.request.id, job_id, code, quality, self))
+    except Exception as e:
+        logger.error(f"[Task {job_id}] Quality upgrade failed: {str(e)}")
+        raise
+    finally:
+        release_upgrade(job_id)
@@ -15,10 +15,35 @@ class Settings(BaseSettings):
     # API Configuration
     GEMINI_API_KEY: str
     SECRET_KEY: str | None = None
-    MODEL_NAME: str = "gemini-2.5-pro"
+    MODEL_NAME: str = "gemini-2.5-flash"  # First drafts
+    FIX_MODEL_NAME: str = "gemini-2.5-pro"  # Fixing code that failed to render
+    FIX_CANDIDATE_TEMPERATURES: list[float] = [0.4, 1.0]  # One concurrent fix request per entry, while Gemini slots are idle
+    GEMINI_MAX_CONCURRENT: int = 4  # In-flight Gemini calls per worker process
+    GEMINI_CACHE_TTL: int = 3600  # Context cache lifetime for the system instruction (0 disables)
     
     # AI Configuration
-    dangerous_patterns: list[str] = ["import os", "import sys", "subprocess", "eval(", "exec(", "open("]
+    # Generated code may only import these modules (and their submodules)
+    allowed_modules: set[str] = {
+        "__future__", "manim", "numpy", "math", "cmath", "random", "itertools", "functools",
+        "collections", "typing", "dataclasses", "enum", "string", "colorsys", "fractions",
+        "statistics", "copy",
+    }
+    # Generated code is rejected if it references any of these by name, calls
+    # them as a method (`io.open(...)`), or accesses them as an attribute or
+    # by string (`attrgetter("__globals__")`)
+    blocked_modules: set[str] = {
+        "os", "sys", "subprocess", "shutil", "socket", "importlib", "builtins", "io", "codecs",
+        "ctypes", "multiprocessing", "pathlib", "pickle", "marshal", "shelve", "tempfile", "glob",
+        "operator", "inspect", "urllib", "http", "requests",
+    }
+    blocked_names: set[str] = {
+        "eval", "exec", "compile", "open", "input", "__import__", "__builtins__",
+        "globals", "locals", "vars", "getattr", "setattr", "delattr", "breakpoint",
+    }
+    blocked_attributes: set[str] = {
+        "__globals__", "__builtins__", "__subclasses__", "__bases__", "__base__",
+        "__mro__", "__code__", "__dict__", "__getattribute__", "__import__", "__loader__",
+    }
     
     system_instruction: str = _load_system_instruction()
     
@@ -28,6 +53,15 @@ class Settings(BaseSettings):
     JOB_SOFT_TIMEOUT: int = 240  # 4 minutes soft limit
     MAX_CONCURRENT_JOBS: int = 2  # Max jobs per user
 
+    # Render Configuration
+    MANIM_WORKERS: int = 2  # Warm Manim processes per Celery worker
+    MANIM_RENDERS_PER_WORKER: int = 50  # Recycle a render process after this many renders (0 = never)
+    MANIM_RENDERER: str = "cairo"  # "cairo", "opengl" (GPU via ModernGL), or "auto" to use opengl when a GPU is present
+    RENDER_TIMEOUT: int = 300  # 5 minutes per render
+    PREVIEW_QUALITY: str = "low_quality"  # 480p 15fps; high_quality is 1080p 60fps
+    UPGRADE_QUALITY: str = "high_quality"  # Re-render quality once the user accepts a preview
+    AUTO_UPGRADE_QUALITY: bool = False  # Queue the UPGRADE_QUALITY render as soon as a preview succeeds
+
     # Auth Configuration
     CLERK_ISSUER: str | None = None # e.g. https://clerk.your-domain.com
     CLERK_AUDIENCE: str | None = None
@@ -39,7 +73,16 @@ class Settings(BaseSettings):
     GENERATED_DIR: Path = Path("generated")
     MEDIA_DIR: Path = Path("media")
     VIDEOS_DIR: Path = Path("media/videos")
+    # Scratch media dir Manim renders into (partial movies, Tex, frames).
+    # On Linux this is tmpfs so render I/O stays in RAM; only the finished
+    # mp4 is moved to VIDEOS_DIR.
+    RENDER_MEDIA_DIR: Path = Path("/dev/shm/manim") if Path("/dev/shm").is_dir() else Path("media")
+    RENDER_TEX_CACHE_MAX_BYTES: int = 256 * 1024 ** 2  # Compiled LaTeX/text kept in RENDER_MEDIA_DIR (0 = unbounded)
     generated_animation_file: Path = Path("generated/animation.py")
+    # Finished renders keyed by a hash of their code, hard-linked into place
+    # when identical code is rendered again
+    VIDEO_CACHE_DIR: Path = Path("media/cache")
+    VIDEO_CACHE_MAX_BYTES: int = 2 * 1024 ** 3  # LRU-evicted above this size (0 disables)
     
     # CORS
     ALLOWED_ORIGINS: str = "http://localhost:5173,http://localhost:3000"
@@ -48,6 +91,10 @@ class Settings(BaseSettings):
     REDIS_URL: str = "redis://localhost:6379/0"
     CELERY_BROKER_URL: str = "redis://localhost:6379/0"
     CELERY_RESULT_BACKEND: str = "redis://localhost:6379/0"
+    CODE_CACHE_TTL: int = 7 * 24 * 3600  # Prompt -> rendered code cache (0 disables)
+    SEMANTIC_CACHE_THRESHOLD: float = 0.95  # Cosine similarity to reuse code from a similar prompt (0 disables)
+    SEMANTIC_CACHE_MAX_ENTRIES: int = 10000  # Prompts kept in the similarity index
+    EMBEDDING_MODEL: str = "models/text-embedding-004"
     
     # AWS S3 Configuration
     AWS_ACCESS_KEY_ID: str | None = None
@@ -58,6 +105,13 @@ class Settings(BaseSettings):
     
     # Storage mode: 'local' or 's3'
     STORAGE_MODE: str = "local"
+    # Let the fronting web server send local videos with sendfile() instead of
+    # streaming them through Python. For nginx, set the prefix of an internal
+    # location aliased to VIDEOS_DIR:
+    #   location /internal-videos/ { internal; alias /app/media/videos/; }
+    VIDEO_ACCEL_REDIRECT_PREFIX: str | None = None
+    # For Apache with mod_xsendfile, which takes the absolute file path
+    VIDEO_XSENDFILE: bool = False
     
     @property
     def allowed_origins(self) -> list[str]:
@@ -89,4 +143,6 @@ settings = Settings()
 # Create necessary directories
 settings.GENERATED_DIR.mkdir(exist_ok=True)
 settings.MEDIA_DIR.mkdir(exist_ok=True)
-settings.VIDEOS_DIR.mkdir(parents=True, exist_ok=True)
\ No newline at end of file
+settings.VIDEOS_DIR.mkdir(parents=True, exist_ok=True)
+settings.RENDER_MEDIA_DIR.mkdir(parents=True, exist_ok=True)
+settings.VIDEO_CACHE_DIR.mkdir(parents=True, exist_ok=True)
\ No newline at end of file
@@ -0,0 +1,27 @@
+"""Gunicorn configuration for running the API in production.
+
+Usage: gunicorn app.main:app -c gunicorn.conf.py
+"""
+import multiprocessing
+import os
+
+bind = os.environ.get("GUNICORN_BIND", "0.0.0.0:8000")
+
+# FastAPI is ASGI, so each worker runs its own uvicorn event loop. With
+# uvicorn[standard] installed that loop is uvloop and HTTP parsing uses
+# httptools; the worker picks both up automatically.
+worker_class = "uvicorn.workers.UvicornWorker"
+workers = int(os.environ.get("GUNICORN_WORKERS", multiprocessing.cpu_count()))
+
+# Import the app (FastAPI, pydantic, boto3, prisma...) once in the master and
+# share it with the forked workers. Network clients are not opened until each
+# worker runs the startup event, so no sockets are shared across the fork.
+preload_app = True
+
+# Rendering runs in Celery, so API requests never block on Manim
+timeout = 120
+graceful_timeout = 30
+
+# Keep idle client connections open so polling clients (GET /status every few
+# seconds) and a fronting proxy reuse them instead of reconnecting
+keepalive = 30
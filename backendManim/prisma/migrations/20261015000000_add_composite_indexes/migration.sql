@@ -0,0 +1,20 @@
+-- DropIndex
+DROP INDEX "jobs_status_idx";
+
+-- DropIndex
+DROP INDEX "jobs_user_id_idx";
+
+-- DropIndex
+DROP INDEX "conversations_user_id_idx";
+
+-- CreateIndex
+CREATE INDEX "jobs_status_created_at_idx" ON "jobs"("status", "created_at" DESC);
+
+-- CreateIndex
+CREATE INDEX "jobs_user_id_created_at_idx" ON "jobs"("user_id", "created_at" DESC);
+
+-- CreateIndex
+CREATE INDEX "jobs_conversation_id_created_at_idx" ON "jobs"("conversation_id", "created_at");
+
+-- CreateIndex
+CREATE INDEX "conversations_user_id_updated_at_idx" ON "conversations"("user_id", "updated_at" DESC);
@@ -0,0 +1,2 @@
+-- AlterTable
+ALTER TABLE "jobs" ADD COLUMN "quality" TEXT;